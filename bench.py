@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Optional
+
+import build
+from build import DepInfo, OutputGroup, Replace, SDKPackage, Symlink
+
+
+def stub_rewrite_pkg():
+    build.rewrite_file("include/config.h", [Replace("@VALUE@", "1"), Replace(r"@FLAG_(\w+)@", r"\1", regex=True)])
+    shutil.copytree("include", os.path.join("out/usr/include", os.path.basename(os.getcwd())), symlinks=True)
+
+
+def stub_dep_pkg(deps: dict[str, DepInfo]):
+    for dep in deps.values():
+        if not os.path.isdir(dep.path):
+            raise Exception(f"missing dependency tree {dep.path}")
+    os.makedirs("out", exist_ok=True)
+    with open("out/deps.h", "w") as f:
+        for name in sorted(deps):
+            f.write(f"#include <{name}/h0.h>\n")
+
+
+def header_text(name: str, index: int, size: int) -> str:
+    body = f"#ifndef {name.upper()}_H{index}\n#define {name.upper()}_H{index}\n"
+    line = f"extern int {name}_symbol_{index}(int argument, const char *label);\n"
+    while len(body) < size:
+        body += line
+    return body + "#endif\n"
+
+
+def commit_all(repo: str, message: str, paths: Optional[list[str]] = None):
+    subprocess.run(["git", "add", "--"] + (paths or ["."]), cwd=repo, check=True)
+    subprocess.run(["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", "commit", "-qm", message], cwd=repo, check=True)
+
+
+def generate_distribution(root: str, packages: int, headers: int, depth: int, header_size: int) -> dict[str, SDKPackage]:
+    upstream_path = os.path.join(root, "upstream")
+    distribution_path = os.path.join(upstream_path, "distribution-macOS")
+    os.makedirs(distribution_path)
+    subprocess.run(["git", "init", "-q", "-b", f"macos-{build.SDK_VERSION.replace('.', '')}"], cwd=distribution_path, check=True)
+    result = {}
+    for i in range(packages):
+        name = f"pkg{i:03d}"
+        repo = os.path.join(upstream_path, name)
+        for k in range(headers):
+            subdir = os.path.join("include", *[f"dir{(k >> level) % 4}" for level in range(depth)]) if k else "include"
+            os.makedirs(os.path.join(repo, subdir), exist_ok=True)
+            with open(os.path.join(repo, subdir, f"h{k}.h"), "w") as f:
+                f.write(header_text(name, k, header_size))
+        with open(os.path.join(repo, "include", "config.h"), "w") as f:
+            f.write("".join(f"#define CONFIG_{k} @VALUE@\n#define FLAG_{k} @FLAG_ON@\n" for k in range(64)))
+        os.makedirs(os.path.join(repo, "src"))
+        with open(os.path.join(repo, "src", "impl.c"), "w") as f:
+            f.write("int impl(void) { return 0; }\n" * 200)
+        subprocess.run(["git", "init", "-q"], cwd=repo, check=True)
+        commit_all(repo, "init")
+        head = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo, check=True, capture_output=True, text=True).stdout.strip()
+        subprocess.run(["git", "config", "-f", ".gitmodules", f"submodule.{name}.path", name], cwd=distribution_path, check=True)
+        subprocess.run(["git", "config", "-f", ".gitmodules", f"submodule.{name}.url", f"file://{repo}"], cwd=distribution_path, check=True)
+        subprocess.run(["git", "update-index", "--add", "--cacheinfo", f"160000,{head},{name}"], cwd=distribution_path, check=True)
+
+        if i % 3 == 0:
+            pkg = SDKPackage(
+                name=name,
+                output_groups=[OutputGroup(sdk_dir=f"usr/include/{name}", globs=["include/**/*"])],
+            )
+        elif i % 3 == 1:
+            pkg = SDKPackage(
+                name=name,
+                build_func=stub_rewrite_pkg,
+                output_groups=[OutputGroup(sdk_dir="", globs=["out/**/*"])],
+            )
+        else:
+            pkg = SDKPackage(
+                name=name,
+                build_func=stub_dep_pkg,
+                dependencies=[f"pkg{i - 1:03d}", f"pkg{i - 2:03d}"],
+                output_groups=[
+                    OutputGroup(sdk_dir=f"usr/include/{name}", globs=["include/**/*.h"]),
+                    OutputGroup(sdk_dir=f"usr/include/{name}", files=["out/deps.h"]),
+                ],
+                symlinks=[Symlink(dir=f"usr/include/{name}", link="current.h", dest="h0.h")],
+            )
+        result[name] = pkg
+    commit_all(distribution_path, "add packages", [".gitmodules"])
+    return result
+
+
+def generate_sdk_lib(root: str, libs: int) -> str:
+    lib_path = os.path.join(root, "MacOSX.sdk", "usr", "lib")
+    for sub in ["", "system", "swift", "swift/shims"]:
+        os.makedirs(os.path.join(lib_path, sub), exist_ok=True)
+    for i in range(libs):
+        sub = ["", "system", "swift"][i % 3]
+        with open(os.path.join(lib_path, sub, f"libstub{i}.tbd"), "w") as f:
+            f.write(f"--- !tapi-tbd\ninstall-name: /usr/lib/libstub{i}.dylib\n" * 20)
+        with open(os.path.join(lib_path, sub, f"libstub{i}.dylib"), "wb") as f:
+            f.write(b"\0" * 4096)
+        if i % 5 == 0:
+            os.symlink(f"libstub{i}.tbd", os.path.join(lib_path, sub, f"libalias{i}.tbd"))
+        if i % 7 == 0:
+            os.symlink(f"libstub{i}.dylib", os.path.join(lib_path, sub, f"libdangling{i}.tbd"))
+    return lib_path
+
+
+def touch_headers(root: str, packages: dict[str, SDKPackage], fraction: float):
+    names = list(packages)
+    step = max(1, round(1 / fraction)) if fraction > 0 else len(names) + 1
+    changed = names[::step]
+    for name in changed:
+        repo = build.package_source_dir(root, packages[name])
+        with open(os.path.join(repo, "include", "h0.h"), "a") as f:
+            f.write(f"/* touched {time.time_ns()} */\n")
+        commit_all(repo, "touch")
+    return changed
+
+
+def scenario(name: str, results: list[dict], run):
+    build.TRACER = build.Tracer()
+    start = time.monotonic()
+    detail = run() or {}
+    wall = time.monotonic() - start
+    summary = build.TRACER.summary({})
+    phases = {}
+    for cat, phase in sorted(summary["phases"].items()):
+        phases[cat] = {
+            "count": phase["count"],
+            "total": phase["total"],
+            "mean_ms": phase["total"] / phase["count"] * 1000,
+            "max_ms": phase["max"] * 1000,
+        }
+    result = {"scenario": name, "wall_time": wall, "phases": phases, "counters": summary["counters"], **detail}
+    results.append(result)
+
+    print(f"{name}: {wall:.3f}s")
+    for cat, phase in phases.items():
+        print(f"  {cat:<10} n={phase['count']:<5} total={phase['total']:.3f}s mean={phase['mean_ms']:.2f}ms max={phase['max_ms']:.2f}ms")
+    for counter, n in sorted(summary["counters"].items()):
+        print(f"  {counter:<16} {n}")
+    if "files" in detail:
+        print(f"  throughput       {detail['files'] / wall:.0f} files/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark build.py's orchestration on a synthetic local distribution")
+    parser.add_argument("--packages", type=int, default=30, help="number of synthetic packages")
+    parser.add_argument("--headers", type=int, default=200, help="headers per package")
+    parser.add_argument("--depth", type=int, default=3, help="directory depth of each package's headers")
+    parser.add_argument("--header-size", type=int, default=2048, help="approximate size of each header in bytes")
+    parser.add_argument("--sdk-libs", type=int, default=600, help="number of stub libraries in the synthetic official SDK")
+    parser.add_argument("--touch", type=float, default=0.1, help="fraction of packages changed for the incremental run")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="number of packages to build concurrently")
+    parser.add_argument("--worktree", choices=["auto", "clone", "hardlink", "copy"], default="auto")
+    parser.add_argument("--materialize", choices=["copy", "hardlink", "clone"], default="copy")
+    parser.add_argument("--work-dir", help="directory for the synthetic tree (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic tree after the run")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    work_dir = os.path.abspath(args.work_dir) if args.work_dir else tempfile.mkdtemp(prefix="sdk-bench-")
+    if os.path.exists(os.path.join(work_dir, "upstream")):
+        parser.error(f"{work_dir} already contains a benchmark tree")
+    os.makedirs(work_dir, exist_ok=True)
+    results: list[dict] = []
+    try:
+        print(f"generating {args.packages} packages with {args.headers} headers each in {work_dir}")
+        start = time.monotonic()
+        packages = generate_distribution(work_dir, args.packages, args.headers, args.depth, args.header_size)
+        sdk_lib_path = generate_sdk_lib(work_dir, args.sdk_libs)
+        print(f"generated in {time.monotonic() - start:.1f}s")
+
+        build.DISTRIBUTION_REPO = f"file://{os.path.join(work_dir, 'upstream', 'distribution-macOS')}"
+        os.environ.update({"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "protocol.file.allow", "GIT_CONFIG_VALUE_0": "always"})
+        jobs = max(1, args.jobs)
+        mirrors = build.MirrorStore(os.path.join(work_dir, "mirrors"), offline=False)
+
+        def fetch(root: str, store: Optional[build.MirrorStore]):
+            build.fetch_sources(packages, os.path.join(work_dir, root), jobs, store)
+            return {"packages": len(packages)}
+
+        scenario("fetch-clone", results, lambda: fetch("fetch-clone", None))
+        scenario("fetch-mirror-cold", results, lambda: fetch("fetch-mirror-cold", mirrors))
+        scenario("fetch-mirror-warm", results, lambda: fetch("build", build.MirrorStore(mirrors.root, offline=False)))
+        build_root = os.path.join(work_dir, "build")
+
+        sdk_path = os.path.join(work_dir, "oss-sdk")
+        os.makedirs(sdk_path)
+        cache = build.BuildCache(os.path.join(work_dir, "cache"), 1 << 40)
+        total_files = args.packages * (args.headers + 1)
+
+        def build_all():
+            build.build_packages(packages, build_root, sdk_path, cache, jobs, None, args.worktree, args.materialize)
+            return {"files": total_files}
+
+        scenario("cold", results, build_all)
+        scenario("warm", results, build_all)
+        changed = touch_headers(build_root, packages, args.touch)
+        scenario("incremental", results, lambda: {**build_all(), "changed_packages": len(changed)})
+        shutil.rmtree(sdk_path)
+        os.makedirs(sdk_path)
+        scenario("reinstall", results, build_all)
+
+        def finalize_copy():
+            dest = os.path.join(sdk_path, "usr", "lib")
+            with build.TRACER.span("finalize_copy", "finalize"):
+                copied = build.copy_tree(sdk_lib_path, dest, include=["*.tbd"], exclude=["swift"], symlinks="valid")
+            return {"files": copied}
+
+        scenario("finalize-copy", results, finalize_copy)
+        scenario("manifest", results, lambda: {"files": len(build.scan_sysroot(sdk_path, jobs, os.path.join(work_dir, "hash-cache.json")))})
+        scenario("manifest-reuse", results, lambda: {"files": len(build.scan_sysroot(sdk_path, jobs, os.path.join(work_dir, "hash-cache.json")))})
+    finally:
+        os.chdir(os.path.dirname(work_dir))
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"parameters": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
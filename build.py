@@ -1,14 +1,41 @@
+import argparse
+import concurrent.futures
+import contextlib
+import ctypes
 import dataclasses
+import errno
+import fcntl
+import filecmp
+import fnmatch
+import functools
 import glob
+import hashlib
+import heapq
+import importlib.util
+import inspect
 import json
+import multiprocessing
 import os
+import posixpath
+import re
+import select
 import shutil
+import signal
+import socket
+import stat
+import struct
 import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
 from collections.abc import Callable
 from typing import Optional, Union
 
 SDK_VERSION = "14.4"
-OFFICIAL_SDK_PATH = f"/Library/Developer/CommandLineTools/SDKs/MacOSX{SDK_VERSION}.sdk"
+DISTRIBUTION_REPO = "https://github.com/apple-oss-distributions/distribution-macOS"
+CACHE_FORMAT_VERSION = 2
 
 
 @dataclasses.dataclass
@@ -19,6 +46,13 @@ class OutputGroup:
     directory: Optional[str] = None
 
 
+@dataclasses.dataclass
+class Replace:
+    find: str
+    replace: str
+    regex: bool = False
+
+
 @dataclasses.dataclass
 class DepInfo:
     path: str
@@ -31,6 +65,53 @@ class Symlink:
     dest: str
 
 
+@dataclasses.dataclass(frozen=True)
+class SDKTarget:
+    version: str = SDK_VERSION
+    arch: str = "arm64"
+    kernel_version: str = "23.1.0"
+
+    @property
+    def name(self) -> str:
+        return f"{self.version}-{self.arch}"
+
+    @property
+    def sdk_path(self) -> str:
+        return f"/Library/Developer/CommandLineTools/SDKs/MacOSX{self.version}.sdk"
+
+
+DEFAULT_TARGET = SDKTarget()
+TARGET = DEFAULT_TARGET
+
+
+def use_target(target: SDKTarget):
+    global TARGET
+    TARGET = target
+
+
+_state_root: Optional[str] = None
+
+
+def use_state_root(path: Optional[str]):
+    global _state_root
+    _state_root = path
+
+
+def package_state_dir(name: str) -> str:
+    if _state_root is None:
+        raise Exception("package state is only available while building a package")
+    path = os.path.join(_state_root, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def parse_target(spec: str) -> SDKTarget:
+    parts = spec.split("-")
+    if len(parts) not in (2, 3) or not all(parts):
+        raise Exception(f"invalid target {spec}, expected VERSION-ARCH or VERSION-ARCH-KERNEL_VERSION")
+    return SDKTarget(*parts)
+
+
 @dataclasses.dataclass
 class SDKPackage:
     name: str
@@ -39,6 +120,9 @@ class SDKPackage:
     dependencies: Optional[list[str]] = None
     symlinks: Optional[list[Symlink]] = None
     alternate_repo: Optional[str] = None
+    build_cost: int = 1
+    inputs: Optional[list[str]] = None
+    target_fields: Optional[list[str]] = None
 
 
 def architecture_pkg():
@@ -50,15 +134,19 @@ def availability_versions_pkg():
 
 
 def dyld_pkg():
-    file_contents_replace("include/mach-o/dyld.h", ", bridgeos(5.0)", "")
-    file_contents_replace("include/mach-o/dyld.h", "__API_UNAVAILABLE(bridgeos) ", "")
-    file_contents_replace("include/mach-o/dyld.h", "DYLD_EXCLAVEKIT_UNAVAILABLE ", "")
-    file_contents_replace("include/mach-o/dyld_priv.h", ", bridgeos(3.0)", "")
+    rewrite_file("include/mach-o/dyld.h", [
+        Replace(", bridgeos(5.0)", ""),
+        Replace("__API_UNAVAILABLE(bridgeos) ", ""),
+        Replace("DYLD_EXCLAVEKIT_UNAVAILABLE ", ""),
+    ])
+    rewrite_file("include/mach-o/dyld_priv.h", [Replace(", bridgeos(3.0)", "")])
 
 
 def icu_pkg():
-    file_contents_replace("makefile", "xcrun --sdk macosx --find", "echo -n")
-    file_contents_replace("makefile", "xcrun --sdk macosx.internal --show-sdk-path", "xcrun --sdk macosx --show-sdk-path")
+    rewrite_file("makefile", [
+        Replace("xcrun --sdk macosx --find", "echo -n"),
+        Replace("xcrun --sdk macosx.internal --show-sdk-path", "xcrun --sdk macosx --show-sdk-path"),
+    ])
     run_cmd([
         "make",
         "MAC_OS_X_VERSION_MIN_REQUIRED=14.0.0",
@@ -82,15 +170,19 @@ def libc_pkg():
 
 
 def libinfo_pkg():
-    file_contents_replace("xcodescripts/install_files.sh", '-o "$INSTALL_OWNER" -g "$INSTALL_GROUP"', "")
-    file_contents_replace("xcodescripts/install_files.sh", "ln -h", "ln -n")
+    rewrite_file("xcodescripts/install_files.sh", [
+        Replace('-o "$INSTALL_OWNER" -g "$INSTALL_GROUP"', ""),
+        Replace("ln -h", "ln -n"),
+    ])
     os.mkdir("out")
     run_cmd(["sh", "xcodescripts/install_files.sh"], {"DSTROOT": "out"})
 
 
 def libmalloc_pkg():
-    file_contents_replace("include/malloc/malloc.h", "TARGET_OS_EXCLAVECORE", "0")
-    file_contents_replace("include/malloc/malloc.h", "TARGET_OS_EXCLAVEKIT", "0")
+    rewrite_file("include/malloc/malloc.h", [
+        Replace("TARGET_OS_EXCLAVECORE", "0"),
+        Replace("TARGET_OS_EXCLAVEKIT", "0"),
+    ])
 
 
 def ncurses_pkg():
@@ -103,19 +195,17 @@ def ncurses_pkg():
 
 
 def objc4_pkg():
-    file_contents_replace("objc.xcodeproj/project.pbxproj", "macosx.internal", "macosx")
+    rewrite_file("objc.xcodeproj/project.pbxproj", [Replace("macosx.internal", "macosx")])
     run_cmd(["xcodebuild", "-target", "objc", "installhdrs", "DSTROOT=out"])
 
 
 def security_pkg():
-    real_framework = f"{OFFICIAL_SDK_PATH}/System/Library/Frameworks/Security.framework"
+    real_framework = f"{TARGET.sdk_path}/System/Library/Frameworks/Security.framework"
     needed_headers = glob.glob(os.path.join(real_framework, "Versions/A/Headers/*.h"))
     needed_headers = [hdr.rsplit("/", 1)[-1] for hdr in needed_headers]
-    os.mkdir("out")
-    shutil.copytree(real_framework, "out/Security.framework", symlinks=True)
     headers_dest = "out/Security.framework/Versions/A/Headers"
-    shutil.rmtree(headers_dest)
-    os.mkdir(headers_dest)
+    copy_tree(real_framework, "out/Security.framework", exclude=["Versions/A/Headers"])
+    os.makedirs(headers_dest)
 
     osx_headers = set(os.listdir("header_symlinks/macOS/Security"))
     common_headers = set(os.listdir("header_symlinks/Security"))
@@ -133,15 +223,17 @@ def security_pkg():
 def xnu_pkg(deps: dict[str, DepInfo]):
     coreos_makefiles_dep = deps["CoreOSMakefiles"]
     coreos_makefiles_path = os.path.join(coreos_makefiles_dep.path, "out")
-    file_contents_replace("libsyscall/Libsyscall.xcconfig", "<DEVELOPER_DIR>", coreos_makefiles_path)
-
-    file_contents_replace("libkern/libkern/Makefile", "EXPORT_MI_GEN_LIST = version.h", "#EXPORT_MI_GEN_LIST = version.h")
-    file_contents_replace("libkern/libkern/Makefile", "version.h: ", "#version.h: ")
-    file_contents_replace("libkern/libkern/Makefile", "\t@$(LOG_GENERATE) ", "#\t@$(LOG_GENERATE) ")
-    file_contents_replace("libkern/libkern/Makefile", "\t$(_v)install ", "#\t$(_v)install ")
-    file_contents_replace("libkern/libkern/Makefile", "\t$(_v)$(NEWVERS) ", "#\t$(_v)$(NEWVERS) ")
+    rewrite_file("libsyscall/Libsyscall.xcconfig", [Replace("<DEVELOPER_DIR>", coreos_makefiles_path)])
+
+    rewrite_file("libkern/libkern/Makefile", [
+        Replace("EXPORT_MI_GEN_LIST = version.h", "#EXPORT_MI_GEN_LIST = version.h"),
+        Replace("version.h: ", "#version.h: "),
+        Replace("\t@$(LOG_GENERATE) ", "#\t@$(LOG_GENERATE) "),
+        Replace("\t$(_v)install ", "#\t$(_v)install "),
+        Replace("\t$(_v)$(NEWVERS) ", "#\t$(_v)$(NEWVERS) "),
+    ])
 
-    file_contents_replace("makedefs/MakeInc.cmd", " ExclaveKit ExclaveCore ", " ")
+    rewrite_file("makedefs/MakeInc.cmd", [Replace(" ExclaveKit ExclaveCore ", " ")])
 
     avail_dep = deps["AvailabilityVersions"]
     avail_script = os.path.join(avail_dep.path, "dst/usr/local/libexec/availability.pl")
@@ -151,29 +243,29 @@ def xnu_pkg(deps: dict[str, DepInfo]):
     run_cmd([
         "make",
         "PLATFORM=MacOSX",
-        f'SDKVERSION={SDK_VERSION}',
-        f'HOST_OS_VERSION={SDK_VERSION}',
-        "ARCH=arm64",
-        "ARCH_CONFIGS=arm64",
-        f'SDKROOT_RESOLVED={OFFICIAL_SDK_PATH}',
-        f'HOST_SDKROOT_RESOLVED={OFFICIAL_SDK_PATH}',
+        f'SDKVERSION={TARGET.version}',
+        f'HOST_OS_VERSION={TARGET.version}',
+        f"ARCH={TARGET.arch}",
+        f"ARCH_CONFIGS={TARGET.arch}",
+        f'SDKROOT_RESOLVED={TARGET.sdk_path}',
+        f'HOST_SDKROOT_RESOLVED={TARGET.sdk_path}',
         "BUILT_PRODUCTS_DIR=.",
         f'DSTROOT="{os.getcwd()}/out"',
-        "RC_DARWIN_KERNEL_VERSION=23.1.0",
+        f"RC_DARWIN_KERNEL_VERSION={TARGET.kernel_version}",
         "installhdrs"
     ], allow_failure=True)
     run_cmd([
         "make",
         'PLATFORM=MacOSX',
-        f'SDKVERSION={SDK_VERSION}',
-        f'HOST_OS_VERSION={SDK_VERSION}',
-        "ARCH=arm64",
-        "ARCH_CONFIGS=arm64",
+        f'SDKVERSION={TARGET.version}',
+        f'HOST_OS_VERSION={TARGET.version}',
+        f"ARCH={TARGET.arch}",
+        f"ARCH_CONFIGS={TARGET.arch}",
         f'SDKROOT_RESOLVED={os.getcwd()}/sdk',
         f'HOST_SDKROOT_RESOLVED={os.getcwd()}/sdk',
         "BUILT_PRODUCTS_DIR=.",
         f'DSTROOT="{os.getcwd()}/out"',
-        "RC_DARWIN_KERNEL_VERSION=23.1.0",
+        f"RC_DARWIN_KERNEL_VERSION={TARGET.kernel_version}",
         "installhdrs"
     ])
 
@@ -183,7 +275,7 @@ def xnu_pkg(deps: dict[str, DepInfo]):
         run_cmd([
             "xcodebuild",
             "-arch",
-            "arm64",
+            TARGET.arch,
             "-target",
             "Build",
             "installhdrs",
@@ -198,19 +290,21 @@ def xnu_pkg(deps: dict[str, DepInfo]):
 
 def coreos_makefiles_pkg():
     run_cmd(["make", "DSTROOT=out", "install"])
-    file_contents_replace("out/Makefiles/CoreOS/Xcode/BSD.xcconfig", "SDKROOT = macosx.internal", "SDKROOT = macosx")
-    file_contents_replace("out/Makefiles/CoreOS/Xcode/BSD.xcconfig", "ARCHS_STANDARD_32_64_BIT", "ARCHS_STANDARD")
+    rewrite_file("out/Makefiles/CoreOS/Xcode/BSD.xcconfig", [
+        Replace("SDKROOT = macosx.internal", "SDKROOT = macosx"),
+        Replace("ARCHS_STANDARD_32_64_BIT", "ARCHS_STANDARD"),
+    ])
 
 
 def launchd_pkg(deps: dict[str, DepInfo]):
     coreos_makefiles_dep = deps["CoreOSMakefiles"]
     coreos_makefiles_path = os.path.join(coreos_makefiles_dep.path, "out")
-    file_contents_replace("xcconfigs/common.xcconfig", "<DEVELOPER_DIR>", coreos_makefiles_path)
-    run_cmd(["xcodebuild", "-arch", "arm64", "-target", "launchd_libs", "installhdrs", f"DSTROOT={os.getcwd()}/out"])
+    rewrite_file("xcconfigs/common.xcconfig", [Replace("<DEVELOPER_DIR>", coreos_makefiles_path)])
+    run_cmd(["xcodebuild", "-arch", TARGET.arch, "-target", "launchd_libs", "installhdrs", f"DSTROOT={os.getcwd()}/out"])
 
 
 def cctools_pkg():
-    file_contents_replace("xcode/macho_dynamic.xcconfig", "SDKROOT=macosx.internal", "SDKROOT=macosx")
+    rewrite_file("xcode/macho_dynamic.xcconfig", [Replace("SDKROOT=macosx.internal", "SDKROOT=macosx")])
     run_cmd(["xcodebuild", "-target", "macho dynamic", "installhdrs", f"DSTROOT={os.getcwd()}/out"])
 
 
@@ -222,57 +316,125 @@ def libm_pkg():
     run_cmd(["xcodebuild", "-target", "InstallHeaders", "installhdrs", f"DSTROOT={os.getcwd()}/out"])
 
 
+def sync_patched_tree(src: str, dest: str) -> list[str]:
+    changed = []
+    wanted = set()
+    for root, dirs, files in os.walk(src):
+        for name in dirs + files:
+            rel = os.path.relpath(os.path.join(root, name), src)
+            wanted.add(rel)
+            dest_path = os.path.join(dest, rel)
+            if name in dirs and not os.path.islink(os.path.join(root, name)):
+                os.makedirs(dest_path, exist_ok=True)
+            elif sync_file(os.path.join(src, rel), dest_path, "copy"):
+                if not os.path.islink(dest_path):
+                    os.utime(dest_path)
+                changed.append(rel)
+    for root, dirs, files in os.walk(dest, topdown=False):
+        for name in files + dirs:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, dest)
+            if rel.split(os.sep)[0] == "build" or rel in wanted:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+            changed.append(rel)
+    return changed
+
+
 def corefoundation_pkg(deps: dict[str, DepInfo]):
     patches_path = os.path.join(os.path.dirname(__file__), "cf-patches")
     patches = os.listdir(patches_path)
     patches.sort()
-    for patch in patches:
-        run_cmd(["patch", "-p1", "-i", os.path.join(patches_path, patch)])
 
-    real_framework = f"{OFFICIAL_SDK_PATH}/System/Library/Frameworks/CoreFoundation.framework"
+    real_framework = f"{TARGET.sdk_path}/System/Library/Frameworks/CoreFoundation.framework"
     icu_includes_path = os.path.join(deps["ICU"].path, "build/usr/local/include")
     libdispatch_includes_path = os.path.join(deps["libdispatch"].path, "private")
     dyld_includes_path = os.path.join(deps["dyld"].path, "include")
-
-    original_cwd = os.getcwd()
-    os.chdir("CoreFoundation")
-    file_contents_replace("PlugIn.subproj/CFBundlePriv.h", "#if (TARGET_OS_MAC", "#if (0")
-    file_contents_replace("Base.subproj/DarwinSymbolAliases", "__TMC15SwiftFoundation19_NSCFConstantString", "#__TMC15SwiftFoundation19_NSCFConstantString")
-
-    os.mkdir("build")
-    os.chdir("build")
     env = os.environ.copy()
     env["CFLAGS"] = f"-Wno-error=undef-prefix -DINCLUDE_OBJC=1 -I{icu_includes_path} -I{libdispatch_includes_path} -I{dyld_includes_path}"
-    try:
-        run_cmd(["cmake", "-DBUILD_SHARED_LIBS=ON", "-DCF_ENABLE_LIBDISPATCH=OFF", ".."], env)
-        run_cmd(["make", "CoreFoundation_POPULATE_HEADERS"], env)
-        os.unlink("CoreFoundation.framework/CoreFoundation")
-        shutil.copy(os.path.join(real_framework, "Versions/A/CoreFoundation.tbd"), "CoreFoundation.framework/Versions/A/CoreFoundation.tbd")
-        os.chdir("CoreFoundation.framework")
-        os.symlink("Versions/Current/CoreFoundation.tbd", "CoreFoundation.tbd")
-    finally:
-        os.chdir(original_cwd)
+    cmake_args = ["cmake", "-DBUILD_SHARED_LIBS=ON", "-DCF_ENABLE_LIBDISPATCH=OFF", ".."]
+
+    state_dir = package_state_dir("CoreFoundation")
+    snapshot_path = os.path.join(state_dir, "CoreFoundation")
+    source_key_path = os.path.join(state_dir, "source.key")
+    configure_key_path = os.path.join(state_dir, "configure.key")
+    h = hashlib.sha256()
+    hash_path(h, "CoreFoundation")
+    hash_path(h, patches_path)
+    h.update(inspect.getsource(corefoundation_pkg).encode())
+    source_key = h.hexdigest()
+    configure_key = hashlib.sha256(f"{env['CFLAGS']}\0{' '.join(cmake_args)}".encode()).hexdigest()
+
+    def read_key(path: str) -> Optional[str]:
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read()
+
+    if read_key(source_key_path) != source_key:
+        for patch in patches:
+            run_cmd(["patch", "-p1", "-i", os.path.join(patches_path, patch)])
+        rewrite_file("CoreFoundation/PlugIn.subproj/CFBundlePriv.h", [Replace("#if (TARGET_OS_MAC", "#if (0")])
+        rewrite_file("CoreFoundation/Base.subproj/DarwinSymbolAliases", [Replace("__TMC15SwiftFoundation19_NSCFConstantString", "#__TMC15SwiftFoundation19_NSCFConstantString")])
+        if os.path.exists(source_key_path):
+            os.unlink(source_key_path)
+        changed = sync_patched_tree("CoreFoundation", snapshot_path)
+        print(f"updated {len(changed)} files in the patched CoreFoundation snapshot")
+        with open(source_key_path, "w") as f:
+            f.write(source_key)
+    else:
+        print("reusing patched CoreFoundation snapshot")
+
+    build_path = os.path.join(snapshot_path, "build")
+    if read_key(configure_key_path) != configure_key or not os.path.exists(os.path.join(build_path, "Makefile")):
+        if os.path.exists(configure_key_path):
+            os.unlink(configure_key_path)
+        if os.path.exists(build_path):
+            shutil.rmtree(build_path)
+        os.mkdir(build_path)
+        run_cmd(cmake_args, env, cwd=build_path)
+        with open(configure_key_path, "w") as f:
+            f.write(configure_key)
+    else:
+        print("reusing configured CoreFoundation build directory")
+    run_cmd(["make", "CoreFoundation_POPULATE_HEADERS"], env, cwd=build_path)
+
+    framework_path = "CoreFoundation/build/CoreFoundation.framework"
+    if os.path.exists("CoreFoundation/build"):
+        shutil.rmtree("CoreFoundation/build")
+    copy_tree(os.path.join(build_path, "CoreFoundation.framework"), framework_path)
+    if os.path.lexists(os.path.join(framework_path, "CoreFoundation")):
+        os.unlink(os.path.join(framework_path, "CoreFoundation"))
+    shutil.copy(os.path.join(real_framework, "Versions/A/CoreFoundation.tbd"), os.path.join(framework_path, "Versions/A/CoreFoundation.tbd"))
+    os.symlink("Versions/Current/CoreFoundation.tbd", os.path.join(framework_path, "CoreFoundation.tbd"))
 
 
 PACKAGES = {
     "CoreOSMakefiles": SDKPackage(
         name="CoreOSMakefiles",
+        build_cost=5,
         alternate_repo="https://github.com/apple-oss-distributions/CoreOSMakefiles",
         build_func=coreos_makefiles_pkg,
         output_groups=[],
     ),
     "architecture": SDKPackage(
         name="architecture",
+        build_cost=2,
         build_func=architecture_pkg,
         output_groups=[OutputGroup(sdk_dir="", globs=["out/**/*"])]
     ),
     "AvailabilityVersions": SDKPackage(
         name="AvailabilityVersions",
+        build_cost=2,
         build_func=availability_versions_pkg,
         output_groups=[OutputGroup(sdk_dir="usr/include", globs=["dst/usr/include/**/*"])]
     ),
     "cctools": SDKPackage(
         name="cctools",
+        build_cost=10,
         alternate_repo="https://github.com/apple-oss-distributions/cctools",
         build_func=cctools_pkg,
         output_groups=[OutputGroup(sdk_dir="usr/include", globs=["out/usr/include/**/*"])]
@@ -283,6 +445,7 @@ PACKAGES = {
     ),
     "ICU": SDKPackage(
         name="ICU",
+        build_cost=40,
         build_func=icu_pkg,
         output_groups=[OutputGroup(sdk_dir="usr/include/unicode", globs=["build/usr/include/unicode/**/*"])]
     ),
@@ -292,6 +455,7 @@ PACKAGES = {
     ),
     "Libc": SDKPackage(
         name="Libc",
+        build_cost=5,
         build_func=libc_pkg,
         output_groups=[
             OutputGroup(sdk_dir="", globs=["out/**/*"]),
@@ -300,12 +464,14 @@ PACKAGES = {
     ),
     "Libm": SDKPackage(
         name="Libm",
+        build_cost=10,
         alternate_repo="https://github.com/apple-oss-distributions/Libm",
         build_func=libm_pkg,
         output_groups=[OutputGroup(sdk_dir="usr/include", globs=["out/usr/include/**/*"])]
     ),
     "Libinfo": SDKPackage(
         name="Libinfo",
+        build_cost=2,
         build_func=libinfo_pkg,
         output_groups=[OutputGroup(sdk_dir="usr/include", files=["out/usr/local/include/aliasdb.h", "out/usr/local/include/bootparams.h"], globs=["out/usr/include/**/*"])]
     ),
@@ -339,8 +505,10 @@ PACKAGES = {
     ),
     "launchd": SDKPackage(
         name="launchd",
+        build_cost=10,
         alternate_repo="https://github.com/apple-oss-distributions/launchd",
         build_func=launchd_pkg,
+        target_fields=["arch"],
         dependencies=["CoreOSMakefiles"],
         output_groups=[OutputGroup(sdk_dir="usr/include", globs=["out/usr/include/*.h"])],
     ),
@@ -451,6 +619,7 @@ PACKAGES = {
     ),
     "ncurses": SDKPackage(
         name="ncurses",
+        build_cost=5,
         build_func=ncurses_pkg,
         output_groups=[OutputGroup(
             sdk_dir="usr/include",
@@ -460,6 +629,7 @@ PACKAGES = {
     ),
     "objc4": SDKPackage(
         name="objc4",
+        build_cost=10,
         build_func=objc4_pkg,
         output_groups=[OutputGroup(sdk_dir="usr/include/objc", globs=["out/usr/include/objc/*"])]
     ),
@@ -473,7 +643,9 @@ PACKAGES = {
     ),
     "Security": SDKPackage(
         name="Security",
+        build_cost=5,
         build_func=security_pkg,
+        target_fields=["version"],
         output_groups=[OutputGroup(sdk_dir="System/Library/Frameworks", directory="out/Security.framework")]
     ),
     "syslog": SDKPackage(
@@ -486,7 +658,9 @@ PACKAGES = {
     ),
     "xnu": SDKPackage(
         name="xnu",
+        build_cost=100,
         build_func=xnu_pkg,
+        target_fields=["version", "arch", "kernel_version"],
         dependencies=["AvailabilityVersions", "CoreOSMakefiles"],
         output_groups=[
             OutputGroup(sdk_dir="", globs=["out/**/*", "libsyscall/out/**/*"]),
@@ -495,168 +669,2581 @@ PACKAGES = {
     ),
     "CoreFoundation": SDKPackage(
         name="CoreFoundation",
+        build_cost=60,
         alternate_repo="https://github.com/apple/swift-corelibs-foundation",
         build_func=corefoundation_pkg,
+        inputs=["cf-patches"],
+        target_fields=["version"],
         dependencies=["dyld", "ICU", "libdispatch"],
         output_groups=[OutputGroup(sdk_dir="System/Library/Frameworks", directory="CoreFoundation/build/CoreFoundation.framework")]
     )
 }
 
 
-def run_cmd(cmd: list[str], env: Optional[dict[str, str]] = None, allow_failure: bool = False):
-    r = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+class Tracer:
+    def __init__(self):
+        self.events: list[dict] = []
+        self.counters: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_ns = time.monotonic_ns()
+
+    @contextlib.contextmanager
+    def package(self, name: str):
+        previous = getattr(self.local, "package", None)
+        self.local.package = name
+        try:
+            yield
+        finally:
+            self.local.package = previous
+
+    @contextlib.contextmanager
+    def span(self, name: str, cat: str, **args):
+        package = getattr(self.local, "package", None)
+        if package is not None:
+            args.setdefault("package", package)
+        start = time.monotonic_ns()
+        try:
+            yield args
+        finally:
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": start / 1000,
+                "dur": (time.monotonic_ns() - start) / 1000,
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def count(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def drain(self) -> tuple[list[dict], dict[str, int]]:
+        with self.lock:
+            events, counters = self.events, self.counters
+            self.events, self.counters = [], {}
+        return events, counters
+
+    def merge(self, drained: tuple[list[dict], dict[str, int]]):
+        events, counters = drained
+        with self.lock:
+            self.events.extend(events)
+        for name, n in counters.items():
+            self.count(name, n)
+
+    def summary(self, packages: dict[str, SDKPackage]) -> dict:
+        phases: dict[str, dict] = {}
+        per_package: dict[str, dict[str, float]] = {}
+        for event in self.events:
+            seconds = event["dur"] / 1e6
+            phase = phases.setdefault(event["cat"], {"count": 0, "total": 0.0, "max": 0.0})
+            phase["count"] += 1
+            phase["total"] += seconds
+            phase["max"] = max(phase["max"], seconds)
+            package = event["args"].get("package")
+            if package is not None:
+                times = per_package.setdefault(package, {})
+                times[event["cat"]] = times.get(event["cat"], 0.0) + seconds
+
+        path_cost: dict[str, tuple[float, list[str]]] = {}
+
+        def critical_path(name: str) -> tuple[float, list[str]]:
+            if name not in path_cost:
+                own = per_package.get(name, {}).get("package", 0.0)
+                deps = [critical_path(dep) for dep in packages[name].dependencies or [] if dep in packages]
+                longest = max(deps, default=(0.0, []))
+                path_cost[name] = (longest[0] + own, longest[1] + [name])
+            return path_cost[name]
+
+        longest = max((critical_path(name) for name in packages), default=(0.0, []))
+        return {
+            "wall_time": (time.monotonic_ns() - self.start_ns) / 1e9,
+            "phases": phases,
+            "packages": per_package,
+            "counters": self.counters,
+            "critical_path": {"duration": longest[0], "packages": longest[1]},
+        }
+
+    def write(self, trace_dir: str, packages: dict[str, SDKPackage]):
+        os.makedirs(trace_dir, exist_ok=True)
+        with open(os.path.join(trace_dir, "build-summary.json"), "w") as f:
+            json.dump(self.summary(packages), f, indent=2)
+        with open(os.path.join(trace_dir, "build-trace.json"), "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+
+TRACER = Tracer()
+
+
+CMD_TAIL_BYTES = 64 * 1024
+CMD_LOG_BACKUPS = 3
+_cmd_log = threading.local()
+_cmd_cancel = None
+_cmd_timeout: Optional[float] = None
+_jobserver_fds: Optional[tuple[int, int, int]] = None
+
+
+class Jobserver:
+    def __init__(self, path: str, tokens: int):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        os.mkfifo(path, 0o600)
+        self.fd = os.open(path, os.O_RDWR)
+        os.write(self.fd, b"+" * tokens)
+
+    def close(self):
+        os.close(self.fd)
+        os.unlink(self.path)
+
+
+def configure_commands(cancel_event, timeout: Optional[float], jobserver_path: Optional[str] = None):
+    global _cmd_cancel, _cmd_timeout, _jobserver_fds
+    _cmd_cancel = cancel_event
+    _cmd_timeout = timeout
+    if jobserver_path is not None:
+        _jobserver_fds = (
+            os.open(jobserver_path, os.O_RDONLY),
+            os.open(jobserver_path, os.O_WRONLY),
+            os.open(jobserver_path, os.O_RDONLY | os.O_NONBLOCK),
+        )
+
+
+def acquire_job_tokens(count: int, blocking: bool) -> int:
+    if _jobserver_fds is None:
+        return 0
+    acquired = 0
+    while acquired < count:
+        try:
+            acquired += len(os.read(_jobserver_fds[2], count - acquired))
+        except BlockingIOError:
+            if not blocking:
+                break
+            if _cmd_cancel is not None and _cmd_cancel.is_set():
+                release_job_tokens(acquired)
+                raise Exception("cancelled while waiting for a jobserver token")
+            select.select([_jobserver_fds[2]], [], [], 0.2)
+    return acquired
+
+
+def release_job_tokens(count: int):
+    if _jobserver_fds is not None and count:
+        os.write(_jobserver_fds[1], b"+" * count)
+
+
+@contextlib.contextmanager
+def job_slot():
+    acquired = acquire_job_tokens(1, blocking=True)
+    try:
+        yield
+    finally:
+        release_job_tokens(acquired)
+
+
+@functools.cache
+def make_jobserver_option() -> str:
+    r = subprocess.run(["make", "--version"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    match = re.search(rb"GNU Make (\d+)\.(\d+)", r.stdout)
+    if match and (int(match[1]), int(match[2])) >= (4, 2):
+        return "--jobserver-auth"
+    return "--jobserver-fds"
+
+
+def jobserver_command(cmd: list[str], env: Optional[dict[str, str]]) -> tuple[list[str], Optional[dict[str, str]], tuple[int, ...], int]:
+    if _jobserver_fds is None:
+        return cmd, env, (), 0
+    tool = os.path.basename(cmd[0])
+    if tool in ("make", "gmake"):
+        env = dict(os.environ if env is None else env)
+        read_fd, write_fd = _jobserver_fds[:2]
+        flags = f"-j {make_jobserver_option()}={read_fd},{write_fd}"
+        env["MAKEFLAGS"] = f"{env['MAKEFLAGS']} {flags}" if env.get("MAKEFLAGS") else f" {flags}"
+        return cmd, env, (read_fd, write_fd), 0
+    if tool == "xcodebuild":
+        extra = acquire_job_tokens(os.cpu_count() or 1, blocking=False)
+        return [cmd[0], "-jobs", str(extra + 1)] + cmd[1:], env, (), extra
+    return cmd, env, (), 0
+
+
+@contextlib.contextmanager
+def command_log(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for i in range(CMD_LOG_BACKUPS, 0, -1):
+        older = path if i == 1 else f"{path}.{i - 1}"
+        if os.path.exists(older):
+            os.replace(older, f"{path}.{i}")
+    previous = getattr(_cmd_log, "path", None)
+    _cmd_log.path = path
+    try:
+        yield
+    finally:
+        _cmd_log.path = previous
+
+
+def kill_process_group(proc: subprocess.Popen):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def run_cmd(
+    cmd: list[str],
+    env: Optional[dict[str, str]] = None,
+    allow_failure: bool = False,
+    cwd: Optional[str] = None,
+    timeout: Optional[float] = None,
+):
+    timeout = timeout if timeout is not None else _cmd_timeout
+    log_path = getattr(_cmd_log, "path", None)
+    cmd, env, pass_fds, extra_tokens = jobserver_command(cmd, env)
+    TRACER.count("commands")
+    try:
+        run_logged_cmd(cmd, env, allow_failure, cwd, timeout, log_path, pass_fds)
+    finally:
+        release_job_tokens(extra_tokens)
+
+
+def run_logged_cmd(
+    cmd: list[str],
+    env: Optional[dict[str, str]],
+    allow_failure: bool,
+    cwd: Optional[str],
+    timeout: Optional[float],
+    log_path: Optional[str],
+    pass_fds: tuple[int, ...],
+):
+    with TRACER.span(os.path.basename(cmd[0]), "cmd", cmd=" ".join(cmd), cwd=cwd or os.getcwd()) as span, \
+            open(log_path or os.devnull, "ab") as log:
+        log.write(f"$ {' '.join(cmd)}\n".encode())
+        log.flush()
+        proc = subprocess.Popen(
+            cmd,
+            env=env,
+            cwd=cwd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+            pass_fds=pass_fds,
+        )
+        tail = bytearray()
+
+        def pump():
+            for chunk in iter(lambda: proc.stdout.read1(65536), b""):
+                log.write(chunk)
+                tail.extend(chunk)
+                del tail[:-CMD_TAIL_BYTES]
+
+        reader = threading.Thread(target=pump, daemon=True)
+        reader.start()
+        deadline = time.monotonic() + timeout if timeout else None
+        reason = None
+        try:
+            while True:
+                try:
+                    returncode = proc.wait(timeout=0.2)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if _cmd_cancel is not None and _cmd_cancel.is_set():
+                    reason = "was cancelled"
+                elif deadline is not None and time.monotonic() > deadline:
+                    reason = f"timed out after {timeout}s"
+                if reason is not None:
+                    kill_process_group(proc)
+                    returncode = proc.wait()
+                    break
+        except BaseException:
+            kill_process_group(proc)
+            raise
+        finally:
+            reader.join()
+            proc.stdout.close()
+        log.write(f"[exit code {returncode}]\n".encode())
+        span["exit_code"] = returncode
+
+    output = tail.decode(errors="replace")
+    log_note = f" (full log: {log_path})" if log_path else ""
+    if reason is not None:
+        raise Exception(f"'{cmd}' {reason}{log_note}\n{output}")
     if not allow_failure:
-        if r.returncode != 0:
-            raise Exception(f"Failed to run '{cmd}'. Exit code {r.returncode}\n{r.stdout.decode()}")
-
-
-def file_contents_replace(file_path: str, find: str, replace: str):
-    modified = False
-    with open(file_path, "rb") as f:
-        contents = f.readlines()
-    for i, line in enumerate(contents):
-        line_str = line.decode()
-        if line_str.find(find) != -1:
-            new_line = line_str.replace(find, replace)
-            contents[i] = new_line.encode()
-            modified = True
-    if modified:
-        with open(file_path, "wb") as f:
-            f.writelines(contents)
-
-
-def finalize_sdk():
-    run_cmd(["curl", "-LO", "https://github.com/ziglang/zig/raw/0.13.0/lib/libc/include/any-macos-any/TargetConditionals.h"])
-    os.rename("TargetConditionals.h", "usr/include/TargetConditionals.h")
-
-    os.makedirs("usr/lib", exist_ok=True)
-    shutil.copytree(
-        f"{OFFICIAL_SDK_PATH}/usr/lib",
-        "usr/lib",
-        symlinks=True,
-        ignore_dangling_symlinks=True,
-        dirs_exist_ok=True,
-        ignore=lambda src, names: [n for n in names if not n.endswith(".tbd") and not os.path.isdir(os.path.join(src, n))]
+        if returncode != 0:
+            raise Exception(f"Failed to run '{cmd}'. Exit code {returncode}{log_note}\n{output}")
+
+
+def rewrite_file(file_path: str, rules: list[Replace]) -> list[int]:
+    with TRACER.span(file_path, "rewrite", rules=len(rules)) as span:
+        patterns = [
+            re.compile(rule.find.encode()) if rule.regex else rule.find.encode()
+            for rule in rules
+        ]
+        replacements = [rule.replace.encode() for rule in rules]
+        counts = [0] * len(rules)
+        changed = False
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(file_path) or ".")
+        try:
+            with open(file_path, "rb") as src, os.fdopen(fd, "wb") as dest:
+                for line in src:
+                    original = line
+                    for i, pattern in enumerate(patterns):
+                        if isinstance(pattern, bytes):
+                            n = line.count(pattern)
+                            if n:
+                                line = line.replace(pattern, replacements[i])
+                        else:
+                            line, n = pattern.subn(replacements[i], line)
+                        counts[i] += n
+                    changed = changed or line != original
+                    dest.write(line)
+            unmatched = [rule.find for rule, n in zip(rules, counts) if n == 0]
+            if unmatched:
+                raise Exception(f"rewrite of {file_path} did not match: {unmatched}")
+            if changed:
+                os.chmod(tmp_path, os.stat(file_path).st_mode | stat.S_IWUSR)
+                os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        span["matches"] = counts
+        TRACER.count("rewrite_matches", sum(counts))
+        return counts
+
+
+def copy_tree(
+    src: str,
+    dest: str,
+    include: Optional[list[str]] = None,
+    exclude: Optional[list[str]] = None,
+    symlinks: str = "preserve",
+    jobs: int = 8,
+) -> int:
+    def excluded(rel: str) -> bool:
+        return any(fnmatch.fnmatchcase(rel, pattern) for pattern in exclude or [])
+
+    def included(rel: str) -> bool:
+        return not include or any(fnmatch.fnmatchcase(rel, pattern) for pattern in include)
+
+    def selected(rel: str) -> bool:
+        parts = rel.split("/")
+        if any(excluded("/".join(parts[:i])) for i in range(1, len(parts) + 1)):
+            return False
+        return os.path.isdir(os.path.join(src, rel)) or included(rel)
+
+    def link_valid(rel: str, target: str) -> bool:
+        resolved = posixpath.normpath(posixpath.join(posixpath.dirname(rel), target))
+        if os.path.isabs(target) or resolved == ".." or resolved.startswith("../"):
+            return os.path.exists(os.path.join(dest, posixpath.dirname(rel), target))
+        return os.path.exists(os.path.join(src, resolved)) and selected(resolved)
+
+    def copy_file(src_path: str, dest_path: str):
+        try:
+            dest_st = os.lstat(dest_path)
+        except FileNotFoundError:
+            dest_st = None
+        if dest_st is not None:
+            src_st = os.stat(src_path)
+            if stat.S_ISREG(dest_st.st_mode) and dest_st.st_size == src_st.st_size and (
+                dest_st.st_mtime_ns == src_st.st_mtime_ns or filecmp.cmp(src_path, dest_path, shallow=False)
+            ):
+                return
+            os.unlink(dest_path)
+        shutil.copy2(src_path, dest_path)
+
+    created_dirs = set()
+
+    def make_parent(dest_path: str):
+        parent = os.path.dirname(dest_path)
+        if parent not in created_dirs:
+            os.makedirs(parent, exist_ok=True)
+            created_dirs.add(parent)
+
+    copied = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        pending = [""]
+        while pending:
+            rel_dir = pending.pop()
+            with os.scandir(os.path.join(src, rel_dir)) as it:
+                for entry in it:
+                    rel = posixpath.join(rel_dir, entry.name) if rel_dir else entry.name
+                    if excluded(rel):
+                        continue
+                    dest_path = os.path.join(dest, rel)
+                    if entry.is_symlink() and symlinks != "follow":
+                        target = os.readlink(entry.path)
+                        if not entry.is_dir() and not included(rel):
+                            continue
+                        if symlinks == "valid" and not link_valid(rel, target):
+                            continue
+                        make_parent(dest_path)
+                        sync_symlink(target, dest_path)
+                        copied += 1
+                    elif entry.is_dir():
+                        pending.append(rel)
+                    elif included(rel):
+                        make_parent(dest_path)
+                        futures.append(pool.submit(copy_file, entry.path, dest_path))
+        for future in futures:
+            future.result()
+    return copied + len(futures)
+
+
+@functools.cache
+def sysroot_mtime() -> int:
+    return int(os.environ.get("SOURCE_DATE_EPOCH", time.time()))
+
+
+TARGET_CONDITIONALS_URL = "https://github.com/ziglang/zig/raw/0.13.0/lib/libc/include/any-macos-any/TargetConditionals.h"
+
+
+def finalize_sdk(mirrors: Optional["MirrorStore"] = None):
+    with TRACER.span("finalize_sdk", "finalize"):
+        if mirrors is not None:
+            shutil.copyfile(mirrors.refresh_file(TARGET_CONDITIONALS_URL), "TargetConditionals.h")
+        else:
+            run_cmd(["curl", "-LO", TARGET_CONDITIONALS_URL])
+        dest = "usr/include/TargetConditionals.h"
+        os.makedirs("usr/include", exist_ok=True)
+        if os.path.exists(dest) and filecmp.cmp("TargetConditionals.h", dest, shallow=False):
+            os.unlink("TargetConditionals.h")
+        else:
+            os.utime("TargetConditionals.h", (sysroot_mtime(), sysroot_mtime()))
+            os.rename("TargetConditionals.h", dest)
+
+        copy_tree(f"{TARGET.sdk_path}/usr/lib", "usr/lib", include=["*.tbd"], exclude=["swift"], symlinks="valid")
+
+
+def archive_compressor(archive_path: str, jobs: int) -> Optional[list[str]]:
+    if archive_path.endswith((".tar.zst", ".tzst")):
+        return ["zstd", "-q", "-19", f"-T{jobs}"]
+    if archive_path.endswith((".tar.xz", ".txz")):
+        return ["xz", "-9", f"-T{max(2, jobs)}"]
+    if archive_path.endswith(".tar"):
+        return None
+    raise Exception(f"unsupported archive format for {archive_path}, expected .tar, .tar.zst or .tar.xz")
+
+
+def file_digest(path: str) -> bytes:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.digest()
+
+
+def export_sysroot(build_sdk_path: str, archive_path: str, jobs: int):
+    with TRACER.span("export", "export", archive=archive_path) as span:
+        entries = []
+        for root, dirs, names in os.walk(build_sdk_path):
+            for name in dirs + names:
+                entries.append(os.path.relpath(os.path.join(root, name), build_sdk_path))
+        entries.sort()
+        regular = [rel for rel in entries if stat.S_ISREG(os.lstat(os.path.join(build_sdk_path, rel)).st_mode)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+            digests = dict(zip(regular, pool.map(file_digest, [os.path.join(build_sdk_path, rel) for rel in regular])))
+
+        mtime = int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+        compressor = archive_compressor(archive_path, jobs)
+        tmp_path = archive_path + ".tmp"
+        first_copy: dict[bytes, str] = {}
+        try:
+            with open(tmp_path, "wb") as out:
+                proc = subprocess.Popen(compressor, stdin=subprocess.PIPE, stdout=out) if compressor else None
+                try:
+                    with tarfile.open(fileobj=proc.stdin if proc else out, mode="w|", format=tarfile.GNU_FORMAT) as tar:
+                        for rel in entries:
+                            path = os.path.join(build_sdk_path, rel)
+                            st = os.lstat(path)
+                            info = tarfile.TarInfo(rel)
+                            info.mtime = mtime
+                            if stat.S_ISLNK(st.st_mode):
+                                info.type = tarfile.SYMTYPE
+                                info.linkname = os.readlink(path)
+                                info.mode = 0o777
+                            elif stat.S_ISDIR(st.st_mode):
+                                info.type = tarfile.DIRTYPE
+                                info.mode = 0o755
+                            else:
+                                info.mode = 0o755 if st.st_mode & 0o111 else 0o644
+                                digest = digests[rel]
+                                if digest in first_copy:
+                                    info.type = tarfile.LNKTYPE
+                                    info.linkname = first_copy[digest]
+                                else:
+                                    first_copy[digest] = rel
+                                    info.size = st.st_size
+                                    with open(path, "rb") as f:
+                                        tar.addfile(info, f)
+                                    continue
+                            tar.addfile(info)
+                finally:
+                    if proc is not None:
+                        proc.stdin.close()
+                        if proc.wait() != 0:
+                            raise Exception(f"{compressor[0]} failed with exit code {proc.returncode}")
+            os.replace(tmp_path, archive_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        span["entries"] = len(entries)
+        span["deduplicated"] = len(regular) - len(first_copy)
+    print(f"exported {len(entries)} entries to {archive_path} ({len(regular) - len(first_copy)} duplicate files stored as hardlinks)")
+
+
+def scan_sysroot(root: str, jobs: int, hash_cache_path: Optional[str] = None) -> dict[str, dict]:
+    hash_cache: dict[str, list] = {}
+    if hash_cache_path is not None and os.path.exists(hash_cache_path):
+        with open(hash_cache_path) as f:
+            hash_cache = json.load(f)
+
+    files: dict[str, dict] = {}
+    to_hash: list[str] = []
+    stats: dict[str, list] = {}
+    for dir_path, dirs, names in os.walk(root):
+        for name in dirs + names:
+            path = os.path.join(dir_path, name)
+            rel = os.path.relpath(path, root)
+            st = os.lstat(path)
+            if stat.S_ISLNK(st.st_mode):
+                files[rel] = {"type": "symlink", "target": os.readlink(path)}
+            elif stat.S_ISREG(st.st_mode):
+                stats[rel] = [st.st_size, st.st_mtime_ns, st.st_ino]
+                files[rel] = {"type": "file", "size": st.st_size}
+                cached = hash_cache.get(rel)
+                if cached is not None and cached[:3] == stats[rel]:
+                    files[rel]["sha256"] = cached[3]
+                else:
+                    to_hash.append(rel)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for rel, digest in zip(to_hash, pool.map(file_digest, [os.path.join(root, rel) for rel in to_hash])):
+            files[rel]["sha256"] = digest.hex()
+    TRACER.count("manifest_hashed", len(to_hash))
+    TRACER.count("manifest_reused", len(stats) - len(to_hash))
+
+    if hash_cache_path is not None:
+        tmp_path = hash_cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({rel: st + [files[rel]["sha256"]] for rel, st in stats.items()}, f)
+        os.replace(tmp_path, hash_cache_path)
+    return files
+
+
+def write_manifest(build_root: str, build_sdk_path: str, installed: dict[str, dict], jobs: int) -> dict[str, dict]:
+    with TRACER.span("manifest", "finalize"):
+        files = scan_sysroot(build_sdk_path, jobs, os.path.join(build_root, "hash-cache.json"))
+        owners = {}
+        for name, record in installed.items():
+            for rel in record["files"]:
+                owners[rel] = name
+        for rel, item in files.items():
+            item["package"] = owners.get(rel, "finalize_sdk")
+
+        manifest_path = f"{build_sdk_path}.manifest.json"
+        tmp_path = manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": 1, "files": files}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, manifest_path)
+    print(f"wrote manifest of {len(files)} sysroot entries to {manifest_path}")
+    return files
+
+
+HEADER_SUFFIXES = (".h", ".hh", ".hpp")
+FRAMEWORK_ROOTS = ["System/Library/Frameworks", "System/Library/PrivateFrameworks"]
+COMPILER_HEADERS = {
+    "arm_acle.h", "arm_neon.h", "cpuid.h", "emmintrin.h", "float.h", "immintrin.h", "iso646.h", "limits.h",
+    "mmintrin.h", "ptrauth.h", "stdalign.h", "stdarg.h", "stdatomic.h", "stdbool.h", "stddef.h", "stdnoreturn.h",
+    "tgmath.h", "unwind.h", "varargs.h", "xmmintrin.h",
+}
+INCLUDE_DIRECTIVE = re.compile(r'^\s*#\s*(?:include|import|include_next)\s*([<"])([^>"]+)[>"]')
+CONDITIONAL_DIRECTIVE = re.compile(r"^\s*#\s*(if|ifdef|ifndef|elif|else|endif|define)\b\s*(.*)")
+
+
+def parse_includes(path: str) -> list[tuple[str, str, bool]]:
+    includes = []
+    stack: list[list] = []
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            match = CONDITIONAL_DIRECTIVE.match(line)
+            if match:
+                directive, condition = match.group(1), match.group(2).strip()
+                if directive == "define":
+                    if stack and stack[-1][1] == "ifndef" and condition.split(" ")[0] == stack[-1][0]:
+                        stack[-1][1] = "guard"
+                elif directive in ("if", "ifdef", "ifndef"):
+                    stack.append([condition, directive])
+                elif directive in ("elif", "else") and stack:
+                    stack[-1] = [f"!({stack[-1][0]}) {condition}", directive]
+                elif directive == "endif" and stack:
+                    stack.pop()
+                continue
+            match = INCLUDE_DIRECTIVE.match(line)
+            if not match:
+                continue
+            conditions = [c for c, kind in stack if kind != "guard"]
+            if any("__has_include" in c or c == "0" for c in conditions):
+                continue
+            includes.append((match.group(1), match.group(2), bool(conditions)))
+    return includes
+
+
+def include_candidates(including: str, quote: str, name: str) -> list[str]:
+    candidates = []
+    if quote == '"':
+        candidates.append(posixpath.normpath(posixpath.join(posixpath.dirname(including), name)))
+    candidates.append(posixpath.join("usr/include", name))
+    if "/" in name:
+        framework, rest = name.split("/", 1)
+        for root in FRAMEWORK_ROOTS:
+            for headers in ("Headers", "PrivateHeaders"):
+                candidates.append(f"{root}/{framework}.framework/{headers}/{rest}")
+    return candidates
+
+
+def validate_sysroot(build_root: str, build_sdk_path: str, files: dict[str, dict], jobs: int) -> list[dict]:
+    with TRACER.span("validate", "finalize") as span:
+        headers = sorted(
+            rel for rel, item in files.items()
+            if item["type"] == "file" and rel.endswith(HEADER_SUFFIXES)
+            and (rel.startswith("usr/include/") or any(rel.startswith(root + "/") for root in FRAMEWORK_ROOTS))
+        )
+        cache_path = os.path.join(build_root, "include-cache.json")
+        parsed: dict[str, list] = {}
+        if os.path.exists(cache_path):
+            with open(cache_path) as f:
+                parsed = json.load(f)
+        misses = sorted({files[rel]["sha256"]: rel for rel in headers if files[rel]["sha256"] not in parsed}.items())
+        if misses:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+                paths = [os.path.join(build_sdk_path, rel) for _, rel in misses]
+                for (digest, _), includes in zip(misses, pool.map(parse_includes, paths, chunksize=64)):
+                    parsed[digest] = includes
+        TRACER.count("headers_parsed", len(misses))
+        TRACER.count("headers_reused", len(headers) - len(misses))
+
+        resolved: dict[str, bool] = {}
+
+        def exists(rel: str) -> bool:
+            if rel not in resolved:
+                resolved[rel] = rel in files or os.path.exists(os.path.join(build_sdk_path, rel))
+            return resolved[rel]
+
+        unresolved = []
+        for rel in headers:
+            for quote, name, conditional in parsed[files[rel]["sha256"]]:
+                if name in COMPILER_HEADERS or (quote == "<" and "." not in posixpath.basename(name)):
+                    continue
+                if not any(exists(candidate) for candidate in include_candidates(rel, quote, name)):
+                    unresolved.append({
+                        "header": rel,
+                        "include": f"{quote}{name}{'>' if quote == '<' else quote}",
+                        "package": files[rel].get("package", ""),
+                        "conditional": conditional,
+                    })
+
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({files[rel]["sha256"]: parsed[files[rel]["sha256"]] for rel in headers}, f)
+        os.replace(tmp_path, cache_path)
+        with open(os.path.join(build_root, "include-report.json"), "w") as f:
+            json.dump({"headers": len(headers), "unresolved": unresolved}, f, indent=1)
+        span["headers"] = len(headers)
+        span["unresolved"] = len(unresolved)
+
+    for item in unresolved:
+        if not item["conditional"]:
+            print(f"{item['header']}: unresolved #include {item['include']} ({item['package']})")
+    conditional = sum(1 for item in unresolved if item["conditional"])
+    print(
+        f"validated {len(headers)} headers: {len(unresolved) - conditional} unresolved includes"
+        f" ({conditional} more only under preprocessor conditions, see include-report.json)"
     )
+    return unresolved
 
-    shutil.rmtree("usr/lib/swift")
-    os.chdir("usr/lib")
-    for lib in os.listdir("."):
-        if os.path.islink(lib):
-            if not os.path.exists(os.readlink(lib)):
-                os.unlink(lib)
 
+PREBUILT_MODULES = {
+    "DarwinSys": "usr/include/sys",
+    "DarwinMach": "usr/include/mach",
+    "Dispatch": "usr/include/dispatch",
+    "ObjectiveC": "usr/include/objc",
+    "CoreFoundation": "System/Library/Frameworks/CoreFoundation.framework/Headers/CoreFoundation.h",
+}
+PREFIX_HEADERS = ["sys/types.h", "mach/mach.h", "dispatch/dispatch.h", "objc/objc.h", "CoreFoundation/CoreFoundation.h"]
+MODULE_CACHE_VERSIONS = 3
+
+
+def existing_module_map(build_sdk_path: str, umbrella: str) -> Optional[str]:
+    candidates = []
+    if umbrella.startswith("usr/include/"):
+        candidates += [posixpath.join(umbrella, "module.modulemap"), "usr/include/module.modulemap"]
+    if ".framework/" in umbrella:
+        candidates.append(umbrella.split(".framework/")[0] + ".framework/Modules/module.modulemap")
+    for candidate in candidates:
+        if os.path.exists(os.path.join(build_sdk_path, candidate)):
+            return candidate
+    return None
+
+
+def prebuild_modules(build_sdk_path: str, files: dict[str, dict], clang: str = "clang") -> str:
+    clang_path = shutil.which(clang)
+    if clang_path is None:
+        raise Exception(f"{clang} not found, prebuilding modules needs a local clang")
+    clang_version = subprocess.run([clang_path, "--version"], capture_output=True, text=True, check=True).stdout.splitlines()[0]
+    triple = f"{TARGET.arch}-apple-macos{TARGET.version}"
+    manifest_digest = hashlib.sha256(json.dumps(files, sort_keys=True).encode()).hexdigest()
+    key = hashlib.sha256(f"{manifest_digest}\0{clang_version}\0{triple}".encode()).hexdigest()[:16]
+    modules_root = f"{build_sdk_path}-modules"
+    out = os.path.join(modules_root, key)
+    if os.path.exists(os.path.join(out, "info.json")):
+        print(f"reusing prebuilt modules in {out}")
+        return out
+    if os.path.exists(out):
+        shutil.rmtree(out)
+    os.makedirs(os.path.join(out, "maps"))
+
+    module_maps = []
+    modules = {}
+    for name, umbrella in PREBUILT_MODULES.items():
+        if not os.path.exists(os.path.join(build_sdk_path, umbrella)):
+            continue
+        existing = existing_module_map(build_sdk_path, umbrella)
+        if existing is None:
+            kind = "umbrella" if os.path.isdir(os.path.join(build_sdk_path, umbrella)) else "umbrella header"
+            map_path = os.path.join(out, "maps", f"{name}.modulemap")
+            with open(map_path, "w") as f:
+                f.write(f'module {name} [system] {{\n  {kind} "{os.path.join(build_sdk_path, umbrella)}"\n  export *\n  module * {{ export * }}\n}}\n')
+            module_maps.append(map_path)
+        modules[name] = {"umbrella": umbrella, "module_map": existing or f"maps/{name}.modulemap"}
+
+    cache_path = os.path.join(out, "ModuleCache")
+    flags = ["-target", triple, "-isysroot", build_sdk_path, "-fmodules", f"-fmodules-cache-path={cache_path}"]
+    flags += [f"-fmodule-map-file={path}" for path in module_maps]
+    for name, module in modules.items():
+        module["languages"] = []
+        source = f"import-{name}.c"
+        with open(os.path.join(out, source), "w") as f:
+            f.write(f"#pragma clang module import {name}\n")
+        for language in ("c", "objective-c"):
+            with TRACER.span(name, "modules", language=language):
+                try:
+                    run_cmd([clang_path, *flags, "-fsyntax-only", "-x", language, source], cwd=out)
+                except Exception as e:
+                    print(f"failed to prebuild module {name} for {language}: {str(e).splitlines()[0]}")
+                else:
+                    module["languages"].append(language)
+
+    prefix = [header for header in PREFIX_HEADERS if any(
+        os.path.exists(os.path.join(build_sdk_path, candidate)) for candidate in include_candidates("", "<", header)
+    )]
+    with open(os.path.join(out, "prefix.h"), "w") as f:
+        f.write("".join(f"#include <{header}>\n" for header in prefix))
+    pchs = []
+    for language, suffix in (("c-header", "c"), ("objective-c-header", "objc")):
+        pch = f"prefix-{suffix}.pch"
+        with TRACER.span(pch, "modules"):
+            try:
+                run_cmd([clang_path, "-target", triple, "-isysroot", build_sdk_path, "-x", language, "prefix.h", "-o", pch], cwd=out)
+            except Exception as e:
+                print(f"failed to build {pch}: {str(e).splitlines()[0]}")
+            else:
+                pchs.append(pch)
+
+    with open(os.path.join(out, "info.json"), "w") as f:
+        json.dump({
+            "manifest": manifest_digest,
+            "clang": clang_version,
+            "target": triple,
+            "flags": flags,
+            "modules": modules,
+            "pch": pchs,
+        }, f, indent=1)
+
+    versions = sorted(
+        (entry for entry in os.listdir(modules_root) if entry != key),
+        key=lambda entry: os.stat(os.path.join(modules_root, entry)).st_mtime,
+    )
+    for entry in versions[:max(0, len(versions) - MODULE_CACHE_VERSIONS + 1)]:
+        shutil.rmtree(os.path.join(modules_root, entry))
+
+    built = sum(1 for module in modules.values() if module["languages"])
+    print(f"prebuilt {built} of {len(modules)} modules and {len(pchs)} PCHs into {out}")
+    return out
+
+
+def load_manifest(path: str, jobs: int) -> dict[str, dict]:
+    if os.path.isdir(path):
+        return scan_sysroot(path, jobs)
+    with open(path) as f:
+        return json.load(f)["files"]
+
+
+def diff_manifests(old: dict[str, dict], new: dict[str, dict]) -> list[tuple[str, str, str]]:
+    differences = []
+    for rel in sorted(old.keys() | new.keys()):
+        if rel not in new:
+            differences.append(("-", rel, old[rel].get("package", "")))
+        elif rel not in old:
+            differences.append(("+", rel, new[rel].get("package", "")))
+        else:
+            old_content = {k: v for k, v in old[rel].items() if k != "package"}
+            new_content = {k: v for k, v in new[rel].items() if k != "package"}
+            if old_content != new_content:
+                differences.append(("M", rel, new[rel].get("package") or old[rel].get("package", "")))
+    return differences
+
+
+def package_priorities(packages: dict[str, SDKPackage]) -> dict[str, int]:
+    dependents: dict[str, list[str]] = {name: [] for name in packages}
+    for name, pkg in packages.items():
+        for dep in pkg.dependencies or []:
+            if dep not in packages:
+                raise Exception(f"{name} depends on unknown package {dep}")
+            dependents[dep].append(name)
+
+    priorities: dict[str, int] = {}
+    visiting = set()
+
+    def visit(name: str) -> int:
+        if name in priorities:
+            return priorities[name]
+        if name in visiting:
+            raise Exception(f"dependency cycle involving {name}")
+        visiting.add(name)
+        priorities[name] = packages[name].build_cost + max((visit(d) for d in dependents[name]), default=0)
+        visiting.remove(name)
+        return priorities[name]
+
+    for name in packages:
+        visit(name)
+    return priorities
+
+
+def package_source_dir(build_root: str, pkg: SDKPackage) -> str:
+    if pkg.alternate_repo is not None:
+        return os.path.join(build_root, pkg.alternate_repo.split("/")[-1])
+    return os.path.join(build_root, "distribution-macOS", pkg.name)
+
+
+def git_output(args: list[str], cwd: str) -> str:
+    r = subprocess.run(["git"] + args, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if r.returncode != 0:
+        raise Exception(f"Failed to run 'git {' '.join(args)}' in {cwd}. Exit code {r.returncode}\n{r.stdout.decode()}")
+    return r.stdout.decode().strip()
+
+
+def hash_path(h, path: str):
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                h.update(os.path.relpath(file_path, path).encode() + b"\0")
+                hash_path(h, file_path)
+    else:
+        with open(path, "rb") as f:
+            h.update(hashlib.sha256(f.read()).digest())
+
+
+def package_cache_key(pkg: SDKPackage, source_dir: str, dep_keys: dict[str, str], target: SDKTarget = DEFAULT_TARGET) -> str:
+    with TRACER.span(pkg.name, "key", package=pkg.name):
+        h = hashlib.sha256()
+        h.update(f"{CACHE_FORMAT_VERSION}\0{pkg.name}\0".encode())
+        for field in pkg.target_fields or []:
+            h.update(f"{field}={getattr(target, field)}\0".encode())
+        h.update(git_output(["rev-parse", "HEAD"], source_dir).encode() + b"\0")
+        if pkg.build_func is not None:
+            h.update(inspect.getsource(pkg.build_func).encode() + b"\0")
+        h.update(repr(pkg.output_groups).encode() + b"\0")
+        h.update(repr(pkg.symlinks).encode() + b"\0")
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+        for input_path in pkg.inputs or []:
+            h.update(input_path.encode() + b"\0")
+            hash_path(h, os.path.join(script_dir, input_path))
+        for dep in sorted(dep_keys):
+            h.update(f"{dep}={dep_keys[dep]}\0".encode())
+        return h.hexdigest()
+
+
+def parse_size(size: str) -> int:
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class BuildCache:
+    def __init__(self, root: str, max_size: int):
+        self.root = root
+        self.max_size = max_size
+        self.pinned: set[str] = set()
+        os.makedirs(root, exist_ok=True)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def lookup(self, key: str) -> Optional[dict]:
+        entry_file = os.path.join(self.entry_path(key), "entry.json")
+        if not os.path.exists(entry_file):
+            return None
+        with open(entry_file) as f:
+            entry = json.load(f)
+        os.utime(self.entry_path(key))
+        return entry
+
+    def store(self, key: str, pkg: SDKPackage, outputs: list[tuple[str, str, str]], replace: bool = False):
+        if os.path.exists(self.entry_path(key)) and not replace:
+            return
+        staging = tempfile.mkdtemp(prefix=f"tmp-{key}-", dir=self.root)
+        try:
+            files_root = os.path.join(staging, "files")
+            os.makedirs(files_root)
+            created_dirs = set()
+            for src, dest, kind in outputs:
+                dest_path = os.path.join(files_root, dest)
+                if kind == "dir":
+                    if dest_path not in created_dirs:
+                        os.makedirs(dest_path, exist_ok=True)
+                        created_dirs.add(dest_path)
+                    continue
+                parent = os.path.dirname(dest_path)
+                if parent not in created_dirs:
+                    os.makedirs(parent, exist_ok=True)
+                    created_dirs.add(parent)
+                if os.path.lexists(dest_path):
+                    os.unlink(dest_path)
+                if kind == "symlink":
+                    os.symlink(os.readlink(src), dest_path)
+                else:
+                    shutil.copy(src, dest_path)
+
+            files = []
+            size = 0
+            for root, dirs, names in os.walk(files_root):
+                for name in dirs + names:
+                    path = os.path.join(root, name)
+                    if name in names or os.path.islink(path):
+                        files.append(os.path.relpath(path, files_root))
+                        size += os.lstat(path).st_size
+            entry = {
+                "package": pkg.name,
+                "files": sorted(files),
+                "symlinks": [dataclasses.asdict(s) for s in pkg.symlinks or []],
+                "size": size,
+            }
+            with open(os.path.join(staging, "entry.json"), "w") as f:
+                json.dump(entry, f)
+            if replace and os.path.exists(self.entry_path(key)):
+                stale = tempfile.mkdtemp(prefix=f"tmp-{key}-", dir=self.root)
+                os.rename(self.entry_path(key), os.path.join(stale, "entry"))
+                shutil.rmtree(stale)
+            try:
+                os.rename(staging, self.entry_path(key))
+            except OSError:
+                if not os.path.exists(os.path.join(self.entry_path(key), "entry.json")):
+                    raise
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+
+    def reference_path(self, owner: str) -> str:
+        return os.path.join(self.root, "references", hashlib.sha256(owner.encode()).hexdigest() + ".json")
+
+    def add_reference(self, owner: str, keys: set[str]):
+        path = self.reference_path(owner)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump({"owner": owner, "keys": sorted(keys)}, f)
+        os.replace(tmp_path, path)
+
+    def referenced_keys(self) -> set[str]:
+        keys: set[str] = set()
+        references_dir = os.path.join(self.root, "references")
+        if not os.path.isdir(references_dir):
+            return keys
+        for name in os.listdir(references_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(references_dir, name)
+            with open(path) as f:
+                reference = json.load(f)
+            if os.path.exists(reference["owner"]):
+                keys |= set(reference["keys"])
+            else:
+                os.unlink(path)
+        return keys
+
+    def evict(self):
+        pinned = self.pinned | self.referenced_keys()
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            entry_file = os.path.join(self.entry_path(key), "entry.json")
+            if key.startswith("tmp-") or not os.path.exists(entry_file):
+                continue
+            with open(entry_file) as f:
+                size = json.load(f)["size"]
+            total += size
+            entries.append((os.stat(self.entry_path(key)).st_mtime, key, size))
+        entries.sort()
+        for _, key, size in entries:
+            if total <= self.max_size:
+                break
+            if key in pinned:
+                continue
+            print(f"evicting cached build {key}")
+            shutil.rmtree(self.entry_path(key))
+            total -= size
+
+
+GLOB_MAGIC = re.compile(r"[*?[]")
+
+
+@dataclasses.dataclass
+class GlobPattern:
+    segments: list[tuple[str, Callable[[str], Optional[re.Match]]]]
+    prefix: str
+    sdk_dir: str
+    order: tuple[int, int]
 
-def main():
-    os.makedirs("sdk-build", exist_ok=True)
-    os.chdir("sdk-build")
-    build_root = os.getcwd()
 
-    build_sdk_path = os.path.join(build_root, f"oss-sdk{SDK_VERSION}")
-    os.makedirs(build_sdk_path, exist_ok=True)
-
-    built_packages_path = os.path.join(build_root, "built-packages.json")
-    built_packages = set()
-    if os.path.exists(built_packages_path):
-        with open(built_packages_path) as f:
-            built_packages = set(json.load(f))
-        print(f"previously built packages: {built_packages}")
-
-    if not os.path.exists("./distribution-macOS"):
-        print("cloning distribution-macOS")
-        run_cmd(["git", "clone", "https://github.com/apple-oss-distributions/distribution-macOS"])
-        os.chdir("distribution-macOS")
-        repo_version = SDK_VERSION.replace(".", "")
-        print("updating distribution-macOS submodules")
-        run_cmd(["git", "checkout", f"macos-{repo_version}"])
-        run_cmd(["git", "submodule", "update", "--init", "--depth", "1"])
-
-    for pkg_name, pkg in PACKAGES.items():
-        if pkg_name in built_packages:
+def scan_globs(path: str, states: set[tuple[int, int]], patterns: list[GlobPattern], emit: Callable[[int, os.DirEntry], None]):
+    for pid, i in list(states):
+        segments = patterns[pid].segments
+        while segments[i][0] == "**" and i + 1 < len(segments):
+            i += 1
+            states.add((pid, i))
+    try:
+        with os.scandir(path or ".") as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        hidden = entry.name.startswith(".")
+        child_states = set()
+        for pid, i in states:
+            segments = patterns[pid].segments
+            text, match = segments[i]
+            last = i + 1 == len(segments)
+            if text == "**":
+                if hidden:
+                    continue
+                if last:
+                    emit(pid, entry)
+                if entry.is_dir():
+                    child_states.add((pid, i))
+            elif match(entry.name) and (not hidden or text.startswith(".")):
+                if last:
+                    emit(pid, entry)
+                elif entry.is_dir():
+                    child_states.add((pid, i + 1))
+        if child_states:
+            scan_globs(entry.path if path else entry.name, child_states, patterns, emit)
+
+
+def scan_tree(src: str, dest: str, emit: Callable[[str, str, str], None]):
+    with os.scandir(src) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        entry_dest = os.path.join(dest, entry.name)
+        if entry.is_symlink():
+            emit(entry.path, entry_dest, "symlink")
+        elif entry.is_dir(follow_symlinks=False):
+            emit(entry.path, entry_dest, "dir")
+            scan_tree(entry.path, entry_dest, emit)
+        else:
+            emit(entry.path, entry_dest, "file")
+
+
+def collect_outputs(pkg: SDKPackage) -> list[tuple[str, str, str]]:
+    outputs: list[tuple[tuple[int, int], str, str, str]] = []
+    patterns: list[GlobPattern] = []
+    roots: dict[str, set[tuple[int, int]]] = {}
+    for group_index, out in enumerate(pkg.output_groups):
+        if out.directory:
+            dir_dest = os.path.join(out.sdk_dir, out.directory.split("/")[-1])
+            order = (group_index, 0)
+            outputs.append((order, out.directory, dir_dest, "dir"))
+            scan_tree(out.directory, dir_dest, lambda src, dest, kind: outputs.append((order, src, dest, kind)))
+        for f in out.files or []:
+            if not os.path.exists(f):
+                raise Exception(f"{pkg.name} did not produce {f}")
+            kind = "dir" if os.path.isdir(f) else "file"
+            outputs.append(((group_index, 1), f, os.path.join(out.sdk_dir, f.rsplit("/", 1)[-1]), kind))
+        for glob_index, g in enumerate(out.globs or []):
+            g_parts = g.split("/")
+            if len(g_parts) > 2 and g_parts[-2] == "**":
+                pfx = "/".join(g_parts[:-2])
+            else:
+                pfx = "/".join(g_parts[:-1])
+            literal = 0
+            while literal < len(g_parts) - 1 and not GLOB_MAGIC.search(g_parts[literal]):
+                literal += 1
+            segments = [(part, re.compile(fnmatch.translate(part)).match) for part in g_parts[literal:]]
+            patterns.append(GlobPattern(segments, pfx, out.sdk_dir, (group_index, 2 + glob_index)))
+            roots.setdefault("/".join(g_parts[:literal]), set()).add((len(patterns) - 1, 0))
+
+    def emit_glob(pid: int, entry: os.DirEntry):
+        pattern = patterns[pid]
+        src = entry.path
+        rel = src[len(pattern.prefix) + 1:] if pattern.prefix and src.startswith(pattern.prefix + "/") else src
+        kind = "dir" if entry.is_dir() else "file"
+        outputs.append((pattern.order, src, os.path.join(pattern.sdk_dir, rel), kind))
+
+    for root, states in roots.items():
+        scan_globs(root, states, patterns, emit_glob)
+
+    produced = {order[0] for order, _, _, kind in outputs if kind != "dir"}
+    for group_index, out in enumerate(pkg.output_groups):
+        if group_index not in produced:
+            raise Exception(f"{pkg.name} produced no files for output group {group_index} ({out.sdk_dir or '/'})")
+
+    outputs.sort(key=lambda o: o[0])
+    return [(src, dest, kind) for _, src, dest, kind in outputs]
+
+
+def package_work_dir(build_root: str, pkg: SDKPackage) -> str:
+    return os.path.join(build_root, "work", pkg.name)
+
+
+def tree_state_path(build_root: str, pkg: SDKPackage) -> str:
+    return package_work_dir(build_root, pkg) + ".key"
+
+
+def tree_built_at(build_root: str, pkg: SDKPackage, key: str) -> bool:
+    try:
+        with open(tree_state_path(build_root, pkg)) as f:
+            return f.read() == key and os.path.isdir(package_work_dir(build_root, pkg))
+    except FileNotFoundError:
+        return False
+
+
+FICLONE = 0x40049409
+_libc = None
+
+
+def clone_file(src: str, dest: str):
+    global _libc
+    if sys.platform == "darwin":
+        if _libc is None:
+            _libc = ctypes.CDLL(None, use_errno=True)
+        if _libc.clonefile(os.fsencode(src), os.fsencode(dest), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dest)
+    else:
+        with open(src, "rb") as s, open(dest, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dest)
+
+
+def git_blob(source_dir: str, sha: str) -> bytes:
+    r = subprocess.run(["git", "cat-file", "blob", sha], cwd=source_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if r.returncode != 0:
+        raise Exception(f"Failed to read blob {sha} in {source_dir}\n{r.stderr.decode()}")
+    return r.stdout
+
+
+def populate_worktree(source_dir: str, work_dir: str, mode: str) -> str:
+    entries = []
+    for record in git_output(["ls-tree", "-r", "-z", "--full-tree", "HEAD"], source_dir).split("\0"):
+        if not record:
             continue
-        print(f"processing {pkg_name}")
-        os.chdir(build_root)
+        meta, f = record.split("\t", 1)
+        file_mode, kind, sha = meta.split()
+        if kind == "blob":
+            entries.append((file_mode, sha, f))
+    dirty = set(git_output(["diff", "--name-only", "-z", "--no-renames", "HEAD"], source_dir).split("\0"))
+    dirs = {os.path.dirname(f) for _, _, f in entries}
+    for d in sorted(dirs):
+        os.makedirs(os.path.join(work_dir, d), exist_ok=True)
+
+    regular = []
+    for file_mode, sha, f in entries:
+        src = os.path.join(source_dir, f)
+        dest = os.path.join(work_dir, f)
+        if f in dirty or not os.path.lexists(src):
+            content = git_blob(source_dir, sha)
+            if file_mode == "120000":
+                os.symlink(os.fsdecode(content), dest)
+            else:
+                with open(dest, "wb") as out:
+                    out.write(content)
+                os.chmod(dest, 0o755 if file_mode == "100755" else 0o644)
+        elif file_mode == "120000":
+            os.symlink(os.readlink(src), dest)
+        else:
+            regular.append(f)
+    if not regular:
+        return mode
+
+    if mode == "auto":
+        try:
+            clone_file(os.path.join(source_dir, regular[0]), os.path.join(work_dir, regular[0]))
+            mode = "clone"
+        except OSError:
+            mode = "copy"
+            os.unlink(os.path.join(work_dir, regular[0]))
+        else:
+            regular = regular[1:]
+
+    if mode == "clone":
+        materialize = clone_file
+    elif mode == "hardlink":
+        def materialize(src: str, dest: str):
+            mode = os.stat(src).st_mode
+            if mode & 0o222:
+                os.chmod(src, mode & ~0o222)
+            os.link(src, dest)
+    elif mode == "copy":
+        materialize = shutil.copy2
+    else:
+        raise Exception(f"unknown worktree mode {mode}")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        for _ in pool.map(lambda f: materialize(os.path.join(source_dir, f), os.path.join(work_dir, f)), regular):
+            pass
+    return mode
+
+
+def build_package(
+    pkg: SDKPackage,
+    build_root: str,
+    dep_info: dict[str, DepInfo],
+    key: str,
+    cache: BuildCache,
+    worktree_mode: str = "auto",
+    replace: bool = False,
+    source_root: Optional[str] = None,
+    target: SDKTarget = DEFAULT_TARGET,
+) -> tuple[list[dict], dict[str, int]]:
+    work_dir = package_work_dir(build_root, pkg)
+    state_path = tree_state_path(build_root, pkg)
+    log_path = os.path.join(build_root, "logs", f"{pkg.name}.log")
+    with job_slot(), TRACER.package(pkg.name), TRACER.span(pkg.name, "package"), command_log(log_path):
+        if os.path.exists(state_path):
+            os.unlink(state_path)
+        with TRACER.span(pkg.name, "worktree", mode=worktree_mode) as span:
+            if os.path.exists(work_dir):
+                shutil.rmtree(work_dir)
+            os.makedirs(work_dir)
+            if worktree_mode == "hardlink" and pkg.build_func is not None:
+                worktree_mode = "auto"
+            span["mode"] = populate_worktree(package_source_dir(source_root or build_root, pkg), work_dir, worktree_mode)
+        os.chdir(work_dir)
+
+        if pkg.build_func is not None:
+            print(f"building {pkg.name}")
+            use_target(target)
+            use_state_root(os.path.join(build_root, "state"))
+            with TRACER.span(pkg.name, "build"):
+                if pkg.dependencies:
+                    pkg.build_func(dep_info)
+                else:
+                    pkg.build_func()
+
+        os.chdir(work_dir)
+        with TRACER.span(pkg.name, "collect") as span:
+            outputs = collect_outputs(pkg)
+            span["entries"] = len(outputs)
+        with TRACER.span(pkg.name, "store"):
+            cache.store(key, pkg, outputs, replace)
+        with open(state_path, "w") as f:
+            f.write(key)
+    return TRACER.drain()
+
+
+def sync_symlink(target: str, dest: str) -> bool:
+    if os.path.islink(dest) and os.readlink(dest) == target:
+        return False
+    replace_path(dest, lambda tmp: os.symlink(target, tmp))
+    return True
+
+
+def sync_file(src: str, dest: str, mode: str) -> bool:
+    src_st = os.lstat(src)
+    if stat.S_ISLNK(src_st.st_mode):
+        return sync_symlink(os.readlink(src), dest)
+    try:
+        dest_st = os.lstat(dest)
+    except FileNotFoundError:
+        dest_st = None
+    if dest_st is not None and stat.S_ISREG(dest_st.st_mode):
+        if (dest_st.st_dev, dest_st.st_ino) == (src_st.st_dev, src_st.st_ino):
+            return False
+        if dest_st.st_size == src_st.st_size and (
+            dest_st.st_mtime_ns == src_st.st_mtime_ns or filecmp.cmp(src, dest, shallow=False)
+        ):
+            return False
+
+    if mode == "hardlink":
+        replace_path(dest, lambda tmp: os.link(src, tmp))
+    elif mode == "clone":
+        replace_path(dest, lambda tmp: clone_file(src, tmp))
+    else:
+        replace_path(dest, lambda tmp: shutil.copy2(src, tmp))
+    return True
+
+
+def replace_path(dest: str, create: Callable[[str], None]):
+    tmp = os.path.join(os.path.dirname(dest), f".tmp-{os.getpid()}-{os.path.basename(dest)}")
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    create(tmp)
+    if os.path.isdir(dest) and not os.path.islink(dest):
+        shutil.rmtree(dest)
+    os.replace(tmp, dest)
+
+
+def install_package(
+    entry_path: str,
+    entry: dict,
+    build_sdk_path: str,
+    previous_files: list[str],
+    mode: str = "copy",
+    mtime: Optional[int] = None,
+) -> tuple[int, int]:
+    files_root = os.path.join(entry_path, "files")
+    created_dirs = set()
+    written = 0
+    with TRACER.span(entry["package"], "install", package=entry["package"]) as span:
+        for rel_path in entry["files"]:
+            dest = os.path.join(build_sdk_path, rel_path)
+            parent = os.path.dirname(dest)
+            if parent not in created_dirs:
+                os.makedirs(parent, exist_ok=True)
+                created_dirs.add(parent)
+            if sync_file(os.path.join(files_root, rel_path), dest, mode):
+                if mtime is not None and not os.path.islink(dest):
+                    os.utime(dest, (mtime, mtime))
+                written += 1
+        span["files"] = len(entry["files"])
+        span["written"] = written
+
+    with TRACER.span(entry["package"], "symlinks", package=entry["package"]):
+        for symlink in entry["symlinks"]:
+            symlink_dir = os.path.join(build_sdk_path, symlink["dir"])
+            os.makedirs(symlink_dir, exist_ok=True)
+            if sync_symlink(symlink["dest"], os.path.join(symlink_dir, symlink["link"])):
+                written += 1
+
+    current = set(installed_files(entry))
+    removed = 0
+    for rel_path in previous_files:
+        stale = os.path.join(build_sdk_path, rel_path)
+        if rel_path not in current and (os.path.islink(stale) or os.path.isfile(stale)):
+            os.unlink(stale)
+            removed += 1
+    TRACER.count("files_written", written + removed)
+    return written, removed
+
+
+class InstallJournal:
+    def __init__(self, path: str):
+        self.path = path
+        self.installed: dict[str, dict] = {}
+        self.interrupted: dict[str, list[str]] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if record["op"] == "begin":
+                        self.interrupted[record["package"]] = record.get("files", [])
+                    elif record["op"] == "commit":
+                        self.interrupted.pop(record["package"], None)
+                        self.installed[record["package"]] = {"key": record["key"], "files": record["files"]}
+        for name, files in self.interrupted.items():
+            print(f"resuming interrupted install of {name}")
+            previous = self.installed.get(name, {"files": []})
+            self.installed[name] = {"key": None, "files": sorted(set(previous["files"]) | set(files))}
+        self.compact()
+
+    def append(self, record: dict):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def begin(self, name: str, key: str, files: list[str]):
+        self.append({"op": "begin", "package": name, "key": key, "files": files})
+
+    def commit(self, name: str, key: str, files: list[str]):
+        self.append({"op": "commit", "package": name, "key": key, "files": files})
+        self.installed[name] = {"key": key, "files": files}
+
+    def compact(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for name, record in self.installed.items():
+                f.write(json.dumps({"op": "commit", "package": name, **record}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def installed_files(entry: dict) -> list[str]:
+    return entry["files"] + [os.path.join(s["dir"], s["link"]) for s in entry["symlinks"]]
+
+
+def overlay_files(cache: BuildCache, installed: dict[str, dict], build_sdk_path: str) -> dict[str, str]:
+    entries: dict[str, tuple[str, str]] = {}
+    for record in installed.values():
+        entry = cache.lookup(record["key"]) if record["key"] is not None else None
+        if entry is None:
+            continue
+        files_root = os.path.join(cache.entry_path(record["key"]), "files")
+        for rel_path in entry["files"]:
+            path = os.path.join(files_root, rel_path)
+            entries[rel_path] = ("link", os.readlink(path)) if os.path.islink(path) else ("file", path)
+        for symlink in entry["symlinks"]:
+            entries[posixpath.join(symlink["dir"], symlink["link"])] = ("link", symlink["dest"])
+    for root, dirs, names in os.walk(build_sdk_path):
+        for name in dirs + names:
+            path = os.path.join(root, name)
+            rel_path = os.path.relpath(path, build_sdk_path).replace(os.sep, "/")
+            if rel_path in entries:
+                continue
+            if os.path.islink(path):
+                entries[rel_path] = ("link", os.readlink(path))
+            elif not os.path.isdir(path):
+                entries[rel_path] = ("file", path)
+
+    dirs = {posixpath.dirname(rel_path) for rel_path in entries}
+    for rel_path in list(dirs):
+        while rel_path:
+            rel_path = posixpath.dirname(rel_path)
+            dirs.add(rel_path)
+
+    def resolve(rel_path: str) -> Optional[tuple[str, str]]:
+        parts = rel_path.split("/")
+        current = ""
+        hops = 0
+        while parts:
+            candidate = posixpath.join(current, parts[0]) if current else parts[0]
+            kind, value = entries.get(candidate, ("", ""))
+            if kind != "link":
+                current = candidate
+                parts = parts[1:]
+                continue
+            hops += 1
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(candidate), value))
+            if hops > 40 or value.startswith("/") or target == ".." or target.startswith("../"):
+                return None
+            current = ""
+            parts = (target.split("/") if target != "." else []) + parts[1:]
+        if entries.get(current, ("", ""))[0] == "file":
+            return "file", entries[current][1]
+        if current in dirs:
+            return "dir", current
+        physical = os.path.join(build_sdk_path, current)
+        return ("file", physical) if os.path.isfile(physical) else None
+
+    files: dict[str, str] = {}
+    pending = list(entries)
+    while pending:
+        rel_path = pending.pop()
+        if rel_path in files:
+            continue
+        resolved = resolve(rel_path)
+        if resolved is None:
+            continue
+        kind, value = resolved
+        if kind == "file":
+            files[rel_path] = value
+        elif entries.get(rel_path, ("", ""))[0] == "link":
+            pending.extend(rel_path + other[len(value):] for other in entries if other.startswith(value + "/"))
+    return files
+
+
+def write_vfs_overlay(path: str, build_sdk_path: str, files: dict[str, str]):
+    root: dict = {}
+    for rel_path in sorted(files):
+        node = root
+        parts = rel_path.split("/")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = files[rel_path]
+
+    def contents(node: dict) -> list[dict]:
+        items = []
+        for name, value in sorted(node.items()):
+            if isinstance(value, dict):
+                items.append({"type": "directory", "name": name, "contents": contents(value)})
+            else:
+                items.append({"type": "file", "name": name, "external-contents": value})
+        return items
+
+    overlay = {
+        "version": 0,
+        "case-sensitive": "false",
+        "roots": [{"type": "directory", "name": build_sdk_path, "contents": contents(root)}],
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(overlay, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def write_sysroot_maps(cache: BuildCache, installed: dict[str, dict], build_sdk_path: str, overlay: bool, header_map: bool):
+    with TRACER.span("overlay", "install"):
+        files = overlay_files(cache, installed, build_sdk_path)
+        if overlay:
+            write_vfs_overlay(f"{build_sdk_path}-overlay.yaml", build_sdk_path, files)
+        if header_map:
+            write_header_map(f"{build_sdk_path}.hmap", files)
+
+
+def header_map_key(rel_path: str) -> Optional[str]:
+    if rel_path.startswith("usr/include/"):
+        return rel_path[len("usr/include/"):]
+    parts = rel_path.split("/")
+    if len(parts) == 6 and parts[:3] == ["System", "Library", "Frameworks"] and parts[4] in ("Headers", "PrivateHeaders"):
+        return f"{parts[3][:-len('.framework')]}/{parts[5]}"
+    return None
+
+
+def write_header_map(path: str, files: dict[str, str]):
+    mapping: dict[str, tuple[str, str]] = {}
+    for rel_path in sorted(files):
+        key = header_map_key(rel_path)
+        if key is not None and key.lower() not in mapping:
+            mapping[key.lower()] = (key, files[rel_path])
+
+    num_buckets = 1
+    while num_buckets < len(mapping) * 2:
+        num_buckets *= 2
+    strings = bytearray(b"\0")
+    offsets: dict[str, int] = {}
+
+    def string_offset(value: str) -> int:
+        if value not in offsets:
+            offsets[value] = len(strings)
+            strings.extend(value.encode() + b"\0")
+        return offsets[value]
+
+    buckets = [(0, 0, 0)] * num_buckets
+    max_value_length = 0
+    for key, target in mapping.values():
+        prefix, suffix = os.path.dirname(target) + "/", os.path.basename(target)
+        max_value_length = max(max_value_length, len(prefix) + len(suffix))
+        index = sum(ord(c) * 13 for c in key.lower()) & (num_buckets - 1)
+        while buckets[index][0]:
+            index = (index + 1) & (num_buckets - 1)
+        buckets[index] = (string_offset(key), string_offset(prefix), string_offset(suffix))
+
+    header_size = 24
+    with open(path, "wb") as f:
+        f.write(struct.pack("<4sHHIIII", b"pamh", 1, 0, header_size + 12 * num_buckets, len(mapping), num_buckets, max_value_length))
+        for bucket in buckets:
+            f.write(struct.pack("<III", *bucket))
+        f.write(strings)
+
+
+def build_packages(
+    packages: dict[str, SDKPackage],
+    build_root: str,
+    build_sdk_path: str,
+    cache: BuildCache,
+    jobs: int,
+    sources: Optional[dict[str, concurrent.futures.Future]] = None,
+    worktree_mode: str = "auto",
+    materialize: str = "copy",
+    keep_going: bool = False,
+    rebuild: Optional[set[str]] = None,
+    header_map: bool = False,
+    source_root: Optional[str] = None,
+    target: SDKTarget = DEFAULT_TARGET,
+    rebuilt_keys: Optional[set[str]] = None,
+):
+    journal = InstallJournal(os.path.join(build_root, "install-journal.jsonl"))
+
+    priorities = package_priorities(packages)
+    install_order = list(packages)
+    keys: dict[str, str] = {}
+    done: set[str] = set()
+    must_build: set[str] = set()
+    forced = set(rebuild or ())
+    replaced: set[str] = set()
+    waiting = {name: set(packages[name].dependencies or []) for name in install_order}
+    ready: list[tuple[int, int, str]] = []
+    failures: list[tuple[str, BaseException]] = []
+    skipped: set[str] = set()
+    next_install = 0
+
+    def push_ready(name: str):
+        heapq.heappush(ready, (-priorities[name], install_order.index(name), name))
+
+    def release_ready():
+        for name in list(waiting):
+            if not waiting[name]:
+                del waiting[name]
+                push_ready(name)
+
+    def mark_done(name: str):
+        done.add(name)
+        for deps in waiting.values():
+            deps.discard(name)
+        release_ready()
+
+    def fail(name: str, error: BaseException):
+        print(f"{name} failed: {error}")
+        failures.append((name, error))
+        skipped.update(plan_packages(packages, rebuild=[name])[1])
+
+    def install_ready():
+        nonlocal next_install
+        changed = False
+        while next_install < len(install_order) and (install_order[next_install] in done or install_order[next_install] in skipped):
+            name = install_order[next_install]
+            next_install += 1
+            if name not in done:
+                continue
+            previous = journal.installed.get(name)
+            if name not in replaced and previous is not None and previous["key"] == keys[name] and (
+                materialize == "overlay" or all(os.path.lexists(os.path.join(build_sdk_path, f)) for f in previous["files"])
+            ):
+                continue
+            entry = cache.lookup(keys[name])
+            journal.begin(name, keys[name], installed_files(entry))
+            if materialize == "overlay":
+                journal.commit(name, keys[name], installed_files(entry))
+                print(f"{name} complete ({len(installed_files(entry))} entries mapped into the overlay)")
+                changed = True
+                continue
+            written, removed = install_package(
+                cache.entry_path(keys[name]), entry, build_sdk_path, previous["files"] if previous else [], materialize, sysroot_mtime()
+            )
+            journal.commit(name, keys[name], installed_files(entry))
+            removed_note = f", {removed} stale removed" if removed else ""
+            print(f"{name} complete ({written} of {len(installed_files(entry))} sysroot entries updated{removed_note})")
+            changed = True
+
+        overlay_path = f"{build_sdk_path}-overlay.yaml"
+        hmap_path = f"{build_sdk_path}.hmap"
+        if materialize == "overlay" and (changed or not os.path.exists(overlay_path)) or (
+            header_map and (changed or not os.path.exists(hmap_path))
+        ):
+            write_sysroot_maps(cache, journal.installed, build_sdk_path, materialize == "overlay", header_map)
+
+    release_ready()
+    mp_context = multiprocessing.get_context("spawn")
+    cancel = mp_context.Event()
+    jobserver = Jobserver(os.path.join(build_root, "jobserver.fifo"), jobs)
+    with contextlib.closing(jobserver), concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=mp_context,
+        initializer=configure_commands,
+        initargs=(cancel, _cmd_timeout, jobserver.path),
+    ) as pool:
+        running: dict[concurrent.futures.Future, str] = {}
+        while True:
+            blocked = []
+            while ready and (keep_going or not failures):
+                _, _, name = ready[0]
+                pkg = packages[name]
+                fetch = sources.get(name) if sources else None
+                if fetch is not None and not fetch.done():
+                    blocked.append(heapq.heappop(ready))
+                    continue
+                if fetch is not None and fetch.exception() is not None:
+                    heapq.heappop(ready)
+                    fail(name, fetch.exception())
+                    continue
+
+                if name not in keys:
+                    dep_keys = {dep: keys[dep] for dep in pkg.dependencies or []}
+                    keys[name] = package_cache_key(pkg, package_source_dir(source_root or build_root, pkg), dep_keys, target)
+                    if rebuilt_keys is not None and keys[name] in rebuilt_keys and name in forced:
+                        forced.discard(name)
+                        replaced.add(name)
+                if name not in must_build and name not in forced and cache.lookup(keys[name]) is not None:
+                    heapq.heappop(ready)
+                    TRACER.count("cache_hits")
+                    mark_done(name)
+                    continue
+
+                missing_trees = [
+                    dep for dep in pkg.dependencies or []
+                    if not tree_built_at(build_root, packages[dep], keys[dep])
+                ]
+                if missing_trees:
+                    heapq.heappop(ready)
+                    waiting[name] = set(missing_trees)
+                    for dep in missing_trees:
+                        if dep not in must_build:
+                            must_build.add(dep)
+                            push_ready(dep)
+                    continue
+
+                if len(running) >= jobs:
+                    break
+                heapq.heappop(ready)
+                dep_info = {
+                    dep: DepInfo(path=package_work_dir(build_root, packages[dep]))
+                    for dep in pkg.dependencies or []
+                }
+                print(f"processing {name}")
+                if name in forced:
+                    TRACER.count("forced_rebuilds")
+                else:
+                    TRACER.count("cache_misses" if name not in must_build else "tree_rebuilds")
+                future = pool.submit(
+                    build_package, pkg, build_root, dep_info, keys[name], cache, worktree_mode, name in forced, source_root, target
+                )
+                running[future] = name
+            for item in blocked:
+                heapq.heappush(ready, item)
+
+            install_ready()
+            fetching = [sources[name] for _, _, name in blocked] if keep_going or not failures else []
+            if not running and not fetching:
+                break
+
+            try:
+                finished, _ = concurrent.futures.wait(list(running) + fetching, return_when=concurrent.futures.FIRST_COMPLETED)
+            except BaseException:
+                cancel.set()
+                raise
+            for future in finished:
+                if future not in running:
+                    continue
+                name = running.pop(future)
+                must_build.discard(name)
+                error = future.exception()
+                if error is not None:
+                    fail(name, error)
+                    if not keep_going:
+                        cancel.set()
+                    continue
+                TRACER.merge(future.result())
+                if name in forced:
+                    forced.discard(name)
+                    replaced.add(name)
+                    if rebuilt_keys is not None:
+                        rebuilt_keys.add(keys[name])
+                mark_done(name)
+
+    journal.compact()
+    installed_keys = {record["key"] for record in journal.installed.values() if record["key"] is not None}
+    if materialize == "overlay" and os.path.exists(f"{build_sdk_path}-overlay.yaml"):
+        cache.add_reference(f"{build_sdk_path}-overlay.yaml", installed_keys)
+    if header_map and os.path.exists(f"{build_sdk_path}.hmap"):
+        cache.add_reference(f"{build_sdk_path}.hmap", installed_keys)
+    cache.pinned |= set(keys.values()) | installed_keys
+    cache.evict()
+    if failures:
+        name, error = failures[0]
+        raise Exception(f"failed to build {', '.join(n for n, _ in failures)}") from error
+
+
+class MirrorStore:
+    def __init__(self, root: str, offline: bool):
+        self.root = root
+        self.offline = offline
+        self.refreshed: dict[str, str] = {}
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def mirror_path(self, url: str) -> str:
+        name = url.split("://", 1)[-1].strip("/")
+        if not name.endswith(".git"):
+            name += ".git"
+        return os.path.join(self.root, *name.split("/"))
+
+    def refresh(self, url: str) -> str:
+        with self.lock:
+            if url in self.refreshed:
+                return self.refreshed[url]
+        path = self.mirror_path(url)
+        if self.offline:
+            if not os.path.exists(path):
+                raise Exception(f"{url} is not mirrored in {self.root}, run once without --offline")
+        elif not os.path.exists(path):
+            print(f"mirroring {url}")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            staging = tempfile.mkdtemp(prefix="tmp-", dir=os.path.dirname(path))
+            try:
+                with TRACER.span(url, "mirror"):
+                    run_cmd(["git", "clone", "--mirror", url, staging])
+                os.rename(staging, path)
+            finally:
+                if os.path.exists(staging):
+                    shutil.rmtree(staging)
+        else:
+            print(f"refreshing mirror of {url}")
+            with TRACER.span(url, "mirror"):
+                run_cmd(["git", "--git-dir", path, "remote", "update", "--prune"])
+        with self.lock:
+            self.refreshed[url] = path
+        return path
+
+    def refresh_file(self, url: str) -> str:
+        path = os.path.join(self.root, "files", *url.split("://", 1)[-1].split("/"))
+        if os.path.exists(path):
+            return path
+        if self.offline:
+            raise Exception(f"{url} is not mirrored in {self.root}, run once without --offline")
+        print(f"mirroring {url}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, staging = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            run_cmd(["curl", "-fL", "-o", staging, url])
+            os.rename(staging, path)
+        finally:
+            if os.path.exists(staging):
+                os.unlink(staging)
+        return path
+
+    def clone_source(self, url: str) -> str:
+        return self.mirror_path(url) if self.offline else url
+
+
+def submodule_url(distribution_path: str, name: str) -> str:
+    url = git_output(["config", "-f", ".gitmodules", "--get", f"submodule.{name}.url"], distribution_path)
+    if url.startswith("../") or url.startswith("./"):
+        url = posixpath.normpath(posixpath.join(DISTRIBUTION_REPO, url))
+        url = url.replace(":/", "://", 1)
+    return url
+
+
+def fetch_package_source(pkg: SDKPackage, build_root: str, mirrors: Optional[MirrorStore]):
+    source_dir = package_source_dir(build_root, pkg)
+    if os.path.exists(os.path.join(source_dir, ".git")):
+        return
+    log_path = os.path.join(build_root, "logs", f"{pkg.name}.fetch.log")
+    with TRACER.package(pkg.name), TRACER.span(pkg.name, "fetch"), command_log(log_path):
         if pkg.alternate_repo is not None:
-            os.chdir(build_root)
-            repo_name = pkg.alternate_repo.split("/")[-1]
-            if not os.path.exists(repo_name):
-                run_cmd(["git", "clone", pkg.alternate_repo])
-            os.chdir(repo_name)
+            print(f"cloning {pkg.alternate_repo.split('/')[-1]}")
+            if mirrors is not None:
+                mirror = mirrors.refresh(pkg.alternate_repo)
+                run_cmd(["git", "clone", "--reference", mirror, mirrors.clone_source(pkg.alternate_repo), source_dir])
+                run_cmd(["git", "remote", "set-url", "origin", pkg.alternate_repo], cwd=source_dir)
+            else:
+                run_cmd(["git", "clone", "--depth", "1", pkg.alternate_repo, source_dir])
         else:
-            os.chdir(os.path.join("distribution-macOS", pkg.name))
+            print(f"fetching {pkg.name}")
+            distribution_path = os.path.dirname(source_dir)
+            if mirrors is not None:
+                mirror = mirrors.refresh(submodule_url(distribution_path, pkg.name))
+                run_cmd(
+                    ["git", "-c", "protocol.file.allow=always", "submodule", "update", "--reference", mirror, "--", pkg.name],
+                    cwd=distribution_path,
+                )
+            else:
+                run_cmd(["git", "submodule", "update", "--depth", "1", "--", pkg.name], cwd=distribution_path)
+
+
+def prepare_distribution(
+    packages: dict[str, SDKPackage], build_root: str, mirrors: Optional[MirrorStore], version: str = SDK_VERSION
+):
+    log_path = os.path.join(build_root, "logs", "distribution-macOS.log")
+    with TRACER.span("distribution-macOS", "fetch"), command_log(log_path):
+        distribution_path = os.path.join(build_root, "distribution-macOS")
+        if not os.path.exists(distribution_path):
+            print("cloning distribution-macOS")
+            if mirrors is not None:
+                mirror = mirrors.refresh(DISTRIBUTION_REPO)
+                run_cmd(["git", "clone", "--no-checkout", "--reference", mirror, mirrors.clone_source(DISTRIBUTION_REPO), distribution_path])
+                run_cmd(["git", "remote", "set-url", "origin", DISTRIBUTION_REPO], cwd=distribution_path)
+            else:
+                run_cmd(["git", "clone", "--filter=blob:none", "--no-checkout", DISTRIBUTION_REPO, distribution_path])
+            repo_version = version.replace(".", "")
+            run_cmd(["git", "checkout", f"macos-{repo_version}"], cwd=distribution_path)
+
+        submodules = [pkg.name for pkg in packages.values() if pkg.alternate_repo is None]
+        if submodules:
+            run_cmd(["git", "submodule", "init", "--"] + submodules, cwd=distribution_path)
+            if mirrors is not None:
+                for name in submodules:
+                    url = submodule_url(distribution_path, name)
+                    run_cmd(["git", "config", f"submodule.{name}.url", mirrors.clone_source(url)], cwd=distribution_path)
+
+
+def plan_packages(
+    packages: dict[str, SDKPackage],
+    only: Optional[list[str]] = None,
+    rebuild: Optional[list[str]] = None,
+) -> tuple[dict[str, SDKPackage], set[str]]:
+    for name in (only or []) + (rebuild or []):
+        if name not in packages:
+            raise Exception(f"unknown package {name}")
+
+    dependents: dict[str, list[str]] = {name: [] for name in packages}
+    for name, pkg in packages.items():
+        for dep in pkg.dependencies or []:
+            dependents[dep].append(name)
+
+    def closure(roots: list[str], edges: Callable[[str], list[str]]) -> set[str]:
+        seen = set()
+        stack = list(roots)
+        while stack:
+            name = stack.pop()
+            if name not in seen:
+                seen.add(name)
+                stack.extend(edges(name))
+        return seen
+
+    forced = closure(rebuild or [], lambda name: dependents[name])
+    if not only and not rebuild:
+        return dict(packages), forced
+    selected = closure(list(set(only or []) | forced), lambda name: packages[name].dependencies or [])
+    return {name: pkg for name, pkg in packages.items() if name in selected}, forced
+
+
+def schedule_order(packages: dict[str, SDKPackage]) -> list[str]:
+    priorities = package_priorities(packages)
+    names = list(packages)
+    waiting = {name: set(packages[name].dependencies or []) for name in names}
+    ready = [(-priorities[name], names.index(name), name) for name in names if not waiting[name]]
+    heapq.heapify(ready)
+    order = []
+    while ready:
+        _, _, name = heapq.heappop(ready)
+        order.append(name)
+        for other, deps in waiting.items():
+            if name in deps:
+                deps.remove(name)
+                if not deps:
+                    heapq.heappush(ready, (-priorities[other], names.index(other), other))
+    return order
+
+
+def start_fetching(
+    packages: dict[str, SDKPackage],
+    build_root: str,
+    pool: concurrent.futures.ThreadPoolExecutor,
+    mirrors: Optional[MirrorStore] = None,
+    version: str = SDK_VERSION,
+) -> dict[str, concurrent.futures.Future]:
+    prepare_distribution(packages, build_root, mirrors, version)
+    print(f"updating {len(packages)} package sources")
+    return {
+        name: pool.submit(fetch_package_source, packages[name], build_root, mirrors)
+        for name in schedule_order(packages)
+    }
 
-        run_cmd(["git", "reset", "--hard", "HEAD"])
-        run_cmd(["git", "clean", "-x", "-f", "-d"])
 
-        if pkg.build_func is not None:
-            print(f"building {pkg_name}")
-            if pkg.dependencies:
-                if not all([dep in built_packages for dep in pkg.dependencies]):
-                    raise Exception(f"deps for {pkg_name} not satisfied, a package can only depend on packages that come before it")
-                dep_info = {}
-                for dep in pkg.dependencies:
-                    if PACKAGES[dep].alternate_repo:
-                        dep_path_root = build_root
-                    else:
-                        dep_path_root = os.path.join(build_root, "distribution-macOS")
-                    dep_info[dep] = DepInfo(path=os.path.join(dep_path_root, PACKAGES[dep].name))
-                pkg.build_func(dep_info)
+def fetch_sources(
+    packages: dict[str, SDKPackage],
+    build_root: str,
+    jobs: int,
+    mirrors: Optional[MirrorStore] = None,
+    version: str = SDK_VERSION,
+):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        for future in start_fetching(packages, build_root, pool, mirrors, version).values():
+            future.result()
+
+
+def target_root(build_root: str, target: SDKTarget) -> str:
+    return build_root if target == DEFAULT_TARGET else os.path.join(build_root, target.name)
+
+
+def source_root(build_root: str, version: str) -> str:
+    return build_root if version == SDK_VERSION else os.path.join(build_root, f"sources-{version}")
+
+
+def build_targets(
+    args: argparse.Namespace,
+    packages: dict[str, SDKPackage],
+    rebuild: set[str],
+    targets: list[SDKTarget],
+    build_root: str,
+    cache: BuildCache,
+    sources: dict[str, dict[str, concurrent.futures.Future]],
+    export_path: Optional[str] = None,
+    mirrors: Optional[MirrorStore] = None,
+):
+    rebuilt_keys: set[str] = set()
+    for target in targets:
+        target_build_root = target_root(build_root, target)
+        build_sdk_path = os.path.join(target_build_root, f"oss-sdk{target.version}")
+        os.makedirs(build_sdk_path, exist_ok=True)
+        if len(targets) > 1:
+            print(f"building target {target.name}")
+        build_packages(
+            packages,
+            target_build_root,
+            build_sdk_path,
+            cache,
+            max(1, args.jobs),
+            sources.get(target.version),
+            args.worktree,
+            args.materialize,
+            args.keep_going,
+            rebuild,
+            args.header_map,
+            source_root=source_root(build_root, target.version),
+            target=target,
+            rebuilt_keys=rebuilt_keys,
+        )
+
+        print("finalizing sdk")
+        os.chdir(build_sdk_path)
+        use_target(target)
+        with command_log(os.path.join(target_build_root, "logs", "finalize.log")):
+            finalize_sdk(mirrors)
+        installed = InstallJournal(os.path.join(target_build_root, "install-journal.jsonl")).installed
+        if args.materialize == "overlay" or args.header_map:
+            write_sysroot_maps(cache, installed, build_sdk_path, args.materialize == "overlay", args.header_map)
+        print(f"sdk {target.name} complete!" if len(targets) > 1 else "sdk complete!")
+        if args.materialize != "overlay":
+            files = write_manifest(target_build_root, build_sdk_path, installed, max(1, args.jobs))
+            if args.validate:
+                validate_sysroot(target_build_root, build_sdk_path, files, max(1, args.jobs))
+            if args.prebuild_modules:
+                with command_log(os.path.join(target_build_root, "logs", "modules.log")):
+                    prebuild_modules(build_sdk_path, files, args.clang)
+        if export_path:
+            export_sysroot(build_sdk_path, export_path.replace("{target}", target.name), max(1, args.jobs))
+
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_EVENTS = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+INOTIFY_EVENT = struct.Struct("iIII")
+WATCH_POLL_INTERVAL = 1.0
+WATCH_DEBOUNCE = 0.2
+
+
+class TreeWatcher:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots: dict[str, bool] = {}
+        self.watches: dict[int, tuple[str, bool]] = {}
+        self.snapshot: dict[str, tuple[int, int]] = {}
+        self.fd: Optional[int] = None
+        if sys.platform.startswith("linux"):
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        if self.fd is None:
+            print(f"inotify is not available, polling for changes every {WATCH_POLL_INTERVAL}s")
+
+    def add(self, path: str, recursive: bool = True):
+        with self.lock:
+            if path in self.roots:
+                return
+            self.roots[path] = recursive
+            if self.fd is not None:
+                try:
+                    self.add_watches(path, recursive)
+                except OSError as e:
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    print("out of inotify watches, polling for changes instead")
+                    os.close(self.fd)
+                    self.fd = None
+                    self.watches.clear()
+                    for root, root_recursive in self.roots.items():
+                        self.snapshot.update(self.scan(root, root_recursive))
+                    return
+            if self.fd is None:
+                self.snapshot.update(self.scan(path, recursive))
+
+    def add_watches(self, path: str, recursive: bool):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_EVENTS)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = (path, recursive)
+        if recursive:
+            for entry in os.scandir(path):
+                if entry.name != ".git" and entry.is_dir(follow_symlinks=False):
+                    self.add_watches(entry.path, True)
+
+    def scan(self, path: str, recursive: bool) -> dict[str, tuple[int, int]]:
+        result = {}
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if d != ".git"] if recursive else []
+            for name in files:
+                file_path = os.path.join(root, name)
+                try:
+                    st = os.lstat(file_path)
+                except FileNotFoundError:
+                    continue
+                result[file_path] = (st.st_mtime_ns, st.st_size)
+        return result
+
+    def wait(self, timeout: Optional[float]) -> set[str]:
+        if self.fd is None:
+            time.sleep(WATCH_POLL_INTERVAL if timeout is None else timeout)
+            with self.lock:
+                if self.fd is not None:
+                    return set()
+                current = {}
+                for root, recursive in self.roots.items():
+                    current.update(self.scan(root, recursive))
+                changed = {path for path in current.keys() | self.snapshot.keys() if current.get(path) != self.snapshot.get(path)}
+                self.snapshot = current
+                return changed
+
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except (OSError, ValueError):
+            return set()
+        if not readable:
+            return set()
+        changed = set()
+        with self.lock:
+            while self.fd is not None:
+                try:
+                    data = os.read(self.fd, 64 * 1024)
+                except BlockingIOError:
+                    break
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                    name = os.fsdecode(data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b"\0"))
+                    offset += INOTIFY_EVENT.size + length
+                    if mask & IN_Q_OVERFLOW:
+                        changed |= set(self.roots)
+                        continue
+                    if wd not in self.watches:
+                        continue
+                    dir_path, recursive = self.watches[wd]
+                    if mask & IN_IGNORED:
+                        del self.watches[wd]
+                        continue
+                    path = os.path.join(dir_path, name) if name else dir_path
+                    changed.add(path)
+                    if recursive and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and name != ".git":
+                        self.add_watches(path, True)
+        return changed
+
+
+def load_script(path: str):
+    spec = importlib.util.spec_from_file_location("build", path)
+    module = importlib.util.module_from_spec(spec)
+    previous = sys.modules.get("build")
+    sys.modules["build"] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        if previous is not None:
+            sys.modules["build"] = previous
+        else:
+            del sys.modules["build"]
+        raise
+    return module
+
+
+def daemon_request(socket_path: str, command: str) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(command.encode() + b"\n")
+        with s.makefile("r") as f:
+            line = f.readline()
+    if not line:
+        raise Exception(f"build daemon at {socket_path} closed the connection")
+    return json.loads(line)
+
+
+class BuildDaemon:
+    def __init__(
+        self,
+        args: argparse.Namespace,
+        targets: list[SDKTarget],
+        build_root: str,
+        cache: BuildCache,
+        mirrors: Optional[MirrorStore],
+        socket_path: str,
+        trace_dir: Optional[str] = None,
+        export_path: Optional[str] = None,
+    ):
+        self.args = args
+        self.targets = targets
+        self.build_root = build_root
+        self.cache = cache
+        self.mirrors = mirrors
+        self.socket_path = socket_path
+        self.trace_dir = trace_dir
+        self.export_path = export_path
+        self.script = sys.modules[__name__]
+        self.script_path = os.path.abspath(__file__)
+        self.watcher = TreeWatcher()
+        self.condition = threading.Condition()
+        self.git_dirs: dict[str, str] = {}
+        self.input_paths: set[str] = set()
+        self.forced: set[str] = set()
+        self.reload = False
+        self.changed = False
+        self.requested = 0
+        self.finished = 0
+        self.building = False
+        self.cycles = 0
+        self.last: Optional[dict] = None
+
+    def watch_sources(self):
+        script = self.script
+        selection, _ = script.plan_packages(script.PACKAGES, self.args.only)
+        git_dirs = {}
+        for version in dict.fromkeys(target.version for target in self.targets):
+            root = script.source_root(self.build_root, version)
+            missing = {
+                name: pkg for name, pkg in selection.items()
+                if not os.path.exists(os.path.join(script.package_source_dir(root, pkg), ".git"))
+            }
+            if missing:
+                script.fetch_sources(missing, root, max(1, self.args.fetch_jobs), self.mirrors, version)
+            for name, pkg in selection.items():
+                git_dirs[script.git_output(["rev-parse", "--absolute-git-dir"], script.package_source_dir(root, pkg))] = name
+        script_dir = os.path.dirname(self.script_path)
+        input_paths = {os.path.join(script_dir, path) for pkg in selection.values() for path in pkg.inputs or []}
+
+        self.watcher.add(script_dir, recursive=False)
+        for git_dir in git_dirs:
+            self.watcher.add(git_dir, recursive=False)
+            self.watcher.add(os.path.join(git_dir, "refs"))
+        for path in sorted(input_paths):
+            if os.path.isdir(path):
+                self.watcher.add(path)
+        with self.condition:
+            self.git_dirs = git_dirs
+            self.input_paths = input_paths
+
+    def record_changes(self, paths: set[str]):
+        with self.condition:
+            reload = self.script_path in paths
+            inputs = any(path == p or path.startswith(p + os.sep) for path in paths for p in self.input_paths)
+            sources = set()
+            for path in paths:
+                for git_dir, name in self.git_dirs.items():
+                    if path.startswith(git_dir + os.sep):
+                        sources.add(name)
+            if not reload and not inputs and not sources:
+                return
+            changes = sorted(sources) + (["build script"] if reload else []) + (["package inputs"] if inputs else [])
+            print(f"change detected in {', '.join(changes)}")
+            self.reload |= reload
+            self.changed = True
+            self.condition.notify_all()
+
+    def watch_changes(self):
+        while True:
+            changed = self.watcher.wait(None)
+            while changed:
+                more = self.watcher.wait(WATCH_DEBOUNCE)
+                if not more:
+                    break
+                changed |= more
+            if changed:
+                self.record_changes(changed)
+
+    def status(self) -> dict:
+        with self.condition:
+            return {
+                "ok": True,
+                "state": "building" if self.building else "idle",
+                "pid": os.getpid(),
+                "targets": [target.name for target in self.targets],
+                "cycles": self.cycles,
+                "pending": {"rebuild": sorted(self.forced), "reload": self.reload, "changed": self.changed},
+                "watched_roots": len(self.watcher.roots),
+                "last": self.last,
+            }
+
+    def request_build(self, names: list[str]) -> dict:
+        with self.condition:
+            unknown = [name for name in names if name not in self.script.PACKAGES]
+            if unknown:
+                return {"ok": False, "error": f"unknown package {', '.join(unknown)}"}
+            self.forced |= set(names)
+            self.requested += 1
+            ticket = self.requested
+            self.condition.notify_all()
+            while self.finished < ticket:
+                self.condition.wait()
+            return self.last
+
+    def handle_request(self, conn: socket.socket):
+        with conn, conn.makefile("rw") as f:
+            try:
+                words = f.readline().split()
+                if words == ["status"]:
+                    response = self.status()
+                elif words[:1] == ["build"]:
+                    response = self.request_build(words[1:])
+                else:
+                    response = {"ok": False, "error": f"unknown request {' '.join(words)!r}"}
+                f.write(json.dumps(response) + "\n")
+                f.flush()
+            except OSError:
+                pass
+
+    def serve_requests(self, server: socket.socket):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self.handle_request, args=(conn,), daemon=True).start()
+
+    def run_cycle(self, forced: set[str], reload: bool) -> dict:
+        start = time.monotonic()
+        result = {"ok": True, "started": time.time(), "reload": reload, "rebuild": sorted(forced)}
+        packages: dict[str, SDKPackage] = {}
+        try:
+            if reload:
+                print("build script changed, reloading package definitions")
+                script = load_script(self.script_path)
+                self.targets = [script.SDKTarget(**dataclasses.asdict(target)) for target in self.targets]
+                self.cache = script.BuildCache(self.cache.root, self.cache.max_size)
+                self.script = script
+                self.watch_sources()
+            script = self.script
+            script.sysroot_mtime.cache_clear()
+            selection, _ = script.plan_packages(script.PACKAGES, self.args.only)
+            packages, rebuild = script.plan_packages(selection, None, sorted(forced & set(selection)))
+            result["packages"] = script.schedule_order(packages)
+            print(f"build plan: {len(packages)} of {len(script.PACKAGES)} packages")
+            script.TRACER = script.Tracer()
+            script.configure_commands(None, self.args.cmd_timeout)
+            try:
+                script.build_targets(
+                    self.args, packages, rebuild, self.targets, self.build_root, self.cache, {}, self.export_path, self.mirrors
+                )
+            finally:
+                script.TRACER.write(self.trace_dir or self.build_root, packages)
+                result["counters"] = script.TRACER.counters
+        except Exception as e:
+            print(f"build failed: {e}")
+            result["ok"] = False
+            result["error"] = str(e)
+        result["duration"] = time.monotonic() - start
+        return result
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            try:
+                daemon_request(self.socket_path, "status")
+            except Exception:
+                os.unlink(self.socket_path)
             else:
-                pkg.build_func()
-
-        for out in pkg.output_groups:
-            dest = os.path.join(build_sdk_path, out.sdk_dir)
-            os.makedirs(dest, exist_ok=True)
-            if out.directory:
-                dir_name = out.directory.split("/")[-1]
-                dir_dest = os.path.join(dest, dir_name)
-                os.mkdir(dir_dest)
-                shutil.copytree(out.directory, dir_dest, symlinks=True, dirs_exist_ok=True)
-            to_copy = []
-            if out.files:
-                for f in out.files:
-                    to_copy.append((f, ""))
-            if out.globs:
-                for g in out.globs:
-                    g_parts = g.split("/")
-                    if len(g_parts) > 2 and g_parts[-2] == "**":
-                        pfx = "/".join(g_parts[:-2])
-                    else:
-                        pfx = "/".join(g_parts[:-1])
-                    for f in glob.glob(g, recursive=True):
-                        d = f.replace(pfx + "/", "")
-                        if "/" in d:
-                            d = d.rsplit("/", 1)[0]
-                        else:
-                            d = ""
-                        to_copy.append((f, d))
-            for (f, d) in to_copy:
-                f_name = f.rsplit("/", 1)[-1]
-                f_dest = os.path.join(dest, d, f_name)
-                if os.path.isdir(f):
-                    os.makedirs(f_dest, exist_ok=True)
+                raise Exception(f"another build daemon is already listening on {self.socket_path}")
+        self.watch_sources()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.socket_path)
+            server.listen()
+            threading.Thread(target=self.watch_changes, daemon=True).start()
+            threading.Thread(target=self.serve_requests, args=(server,), daemon=True).start()
+            print(f"watching {len(self.watcher.roots)} directories for changes, requests on {self.socket_path}")
+            while True:
+                with self.condition:
+                    while not self.changed and self.finished == self.requested:
+                        self.condition.wait()
+                    forced, reload, ticket = self.forced, self.reload, self.requested
+                    self.forced, self.reload, self.changed = set(), False, False
+                    self.building = True
+                result = self.run_cycle(forced, reload)
+                with self.condition:
+                    self.building = False
+                    self.cycles += 1
+                    self.last = result
+                    self.finished = ticket
+                    self.condition.notify_all()
+                print("waiting for changes")
+        finally:
+            server.close()
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an OSS Darwin sysroot")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of packages to build concurrently, also the make jobserver's total job budget",
+    )
+    parser.add_argument("--fetch-jobs", type=int, default=8, help="number of package sources to fetch concurrently")
+    parser.add_argument("-k", "--keep-going", action="store_true", help="keep building packages that do not depend on a failed one")
+    parser.add_argument(
+        "--only", nargs="+", default=[], metavar="PACKAGE", help="build only these packages and the packages they depend on"
+    )
+    parser.add_argument(
+        "--rebuild",
+        nargs="+",
+        default=[],
+        metavar="PACKAGE",
+        help="rebuild these packages and everything that depends on them, ignoring cached outputs",
+    )
+    parser.add_argument(
+        "--target",
+        action="append",
+        default=[],
+        metavar="VERSION-ARCH",
+        help=f"SDK target to build, e.g. 14.4-x86_64 (repeatable; default {DEFAULT_TARGET.name})",
+    )
+    parser.add_argument("--pipeline", action="store_true", help="start building packages while other sources are still being fetched")
+    parser.add_argument(
+        "--worktree",
+        choices=["auto", "clone", "hardlink", "copy"],
+        default="auto",
+        help="how scratch build trees are populated from the pristine checkouts (auto: clone if supported, else copy; "
+        "hardlink only applies to packages without a build step)",
+    )
+    parser.add_argument(
+        "--materialize",
+        choices=["copy", "hardlink", "clone", "overlay"],
+        default="copy",
+        help="how changed files are written into the sysroot from the package cache (overlay: write a clang -ivfsoverlay file instead)",
+    )
+    parser.add_argument("--header-map", action="store_true", help="also write a clang header map of the sysroot's headers")
+    parser.add_argument(
+        "--validate", action="store_true", help="check that every #include in the sysroot's headers resolves inside the sysroot"
+    )
+    parser.add_argument(
+        "--prebuild-modules",
+        action="store_true",
+        help="prebuild a clang module cache and PCHs for common system headers next to the sysroot",
+    )
+    parser.add_argument("--clang", default="clang", help="clang used by --prebuild-modules (default: clang)")
+    parser.add_argument(
+        "--export",
+        metavar="ARCHIVE",
+        help="write a reproducible .tar, .tar.zst or .tar.xz of the finished sysroot; archive entries get SOURCE_DATE_EPOCH "
+        "as their mtime (0 if unset), while files written into the sysroot itself get SOURCE_DATE_EPOCH or the build's start time",
+    )
+    parser.add_argument(
+        "--diff",
+        nargs=2,
+        metavar=("OLD", "NEW"),
+        help="compare two sysroot manifests or directories and exit, instead of building",
+    )
+    parser.add_argument(
+        "--verify", action="store_true", help="check the built sysroot against its recorded manifest and exit, instead of building"
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="after building, keep running: rebuild the affected packages whenever the build script, package inputs "
+        "or the commits checked out in the package sources change",
+    )
+    parser.add_argument("--socket", help="unix socket the --watch daemon answers requests on (default: sdk-build/daemon.sock)")
+    parser.add_argument(
+        "--request",
+        choices=["build", "status"],
+        help="ask a running --watch daemon to build now (with any --rebuild packages) or report its status, and exit",
+    )
+    parser.add_argument("--mirror-dir", help="persistent directory of bare git mirrors that clones borrow objects from")
+    parser.add_argument("--offline", action="store_true", help="fetch sources only from --mirror-dir, without network access")
+    parser.add_argument("--cache-dir", help="directory for cached package outputs (default: sdk-build/cache)")
+    parser.add_argument("--cache-size", default="20G", help="maximum size of the package cache, e.g. 500M or 20G")
+    parser.add_argument("--cmd-timeout", type=float, help="kill any single build command that runs longer than this many seconds")
+    parser.add_argument("--trace-dir", help="directory for build-summary.json and build-trace.json (default: sdk-build)")
+    args = parser.parse_args()
+    if args.offline and not args.mirror_dir:
+        parser.error("--offline requires --mirror-dir")
+    if (args.validate or args.prebuild_modules) and args.materialize == "overlay":
+        parser.error("--validate and --prebuild-modules need a physical sysroot and cannot be used with --materialize overlay")
+
+    socket_path = os.path.abspath(args.socket or os.path.join("sdk-build", "daemon.sock"))
+    if args.request:
+        command = " ".join([args.request] + (args.rebuild if args.request == "build" else []))
+        try:
+            response = daemon_request(socket_path, command)
+        except OSError as e:
+            parser.error(f"no build daemon is listening on {socket_path}: {e}")
+        print(json.dumps(response, indent=2))
+        sys.exit(0 if response.get("ok") else 1)
+
+    try:
+        targets = list(dict.fromkeys(parse_target(spec) for spec in args.target)) or [DEFAULT_TARGET]
+    except Exception as e:
+        parser.error(str(e))
+
+    export_path = os.path.abspath(args.export) if args.export else None
+    if export_path:
+        if len(targets) > 1 and "{target}" not in export_path:
+            parser.error("--export needs a {target} placeholder when building more than one --target")
+        try:
+            archive_compressor(export_path, 1)
+        except Exception as e:
+            parser.error(str(e))
+
+    if args.diff or args.verify:
+        jobs = max(1, args.jobs)
+        comparisons = []
+        if args.diff:
+            comparisons.append((load_manifest(args.diff[0], jobs), load_manifest(args.diff[1], jobs)))
+        else:
+            for target in targets:
+                build_root = target_root(os.path.abspath("sdk-build"), target)
+                build_sdk_path = os.path.join(build_root, f"oss-sdk{target.version}")
+                manifest_path = f"{build_sdk_path}.manifest.json"
+                if not os.path.exists(manifest_path):
+                    parser.error(f"no manifest has been recorded at {manifest_path}")
+                comparisons.append(
+                    (load_manifest(manifest_path, jobs), scan_sysroot(build_sdk_path, jobs, os.path.join(build_root, "hash-cache.json")))
+                )
+        differences = []
+        for old, new in comparisons:
+            differences += diff_manifests(old, new)
+        for op, rel, package in differences:
+            print(f"{op} {rel}" + (f" ({package})" if package else ""))
+        print(f"{len(differences)} differences")
+        sys.exit(1 if differences else 0)
+
+    try:
+        packages, rebuild = plan_packages(PACKAGES, args.only, args.rebuild)
+    except Exception as e:
+        parser.error(str(e))
+    print(f"build plan: {len(packages)} of {len(PACKAGES)} packages for {', '.join(t.name for t in targets)}")
+    for name in schedule_order(packages):
+        print(f"  {name}{' (rebuild)' if name in rebuild else ''}")
+
+    configure_commands(None, args.cmd_timeout)
+    mirrors = MirrorStore(os.path.abspath(args.mirror_dir), args.offline) if args.mirror_dir else None
+    cache_dir = os.path.abspath(args.cache_dir) if args.cache_dir else None
+    trace_dir = os.path.abspath(args.trace_dir) if args.trace_dir else None
+    os.makedirs("sdk-build", exist_ok=True)
+    os.chdir("sdk-build")
+    build_root = os.getcwd()
+    cache = BuildCache(cache_dir or os.path.join(build_root, "cache"), parse_size(args.cache_size))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.fetch_jobs)) as fetch_pool:
+            sources = {}
+            for version in dict.fromkeys(target.version for target in targets):
+                os.makedirs(source_root(build_root, version), exist_ok=True)
+                if args.pipeline:
+                    sources[version] = start_fetching(packages, source_root(build_root, version), fetch_pool, mirrors, version)
                 else:
-                    shutil.copy(f, f_dest)
-
-        if pkg.symlinks:
-            for symlink in pkg.symlinks:
-                original_cwd = os.getcwd()
-                symlink_dir = os.path.join(build_sdk_path, symlink.dir)
-                if not os.path.exists(symlink_dir):
-                    os.makedirs(symlink_dir)
-                os.chdir(symlink_dir)
-                os.symlink(symlink.dest, symlink.link)
-                os.chdir(original_cwd)
-
-        built_packages.add(pkg_name)
-        with open(built_packages_path, "w") as f:
-            json.dump(list(built_packages), f)
-        print(f"{pkg_name} complete")
-
-    print("finalizing sdk")
-    os.chdir(build_sdk_path)
-    finalize_sdk()
-    print("sdk complete!")
+                    fetch_sources(packages, source_root(build_root, version), max(1, args.fetch_jobs), mirrors, version)
+
+            build_targets(args, packages, rebuild, targets, build_root, cache, sources, export_path, mirrors)
+    except Exception as e:
+        if not args.watch:
+            raise
+        print(f"build failed: {e}")
+    finally:
+        TRACER.write(trace_dir or build_root, packages)
+
+    if args.watch:
+        BuildDaemon(args, targets, build_root, cache, mirrors, socket_path, trace_dir, export_path).serve()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,109 @@
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import build  # noqa: E402
+from build import OutputGroup, SDKPackage, Symlink  # noqa: E402
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "test",
+    "GIT_AUTHOR_EMAIL": "test@localhost",
+    "GIT_COMMITTER_NAME": "test",
+    "GIT_COMMITTER_EMAIL": "test@localhost",
+    "GIT_CONFIG_GLOBAL": os.devnull,
+    "GIT_CONFIG_NOSYSTEM": "1",
+}
+
+
+@pytest.fixture(autouse=True)
+def git_identity(monkeypatch):
+    for name, value in GIT_ENV.items():
+        monkeypatch.setenv(name, value)
+
+
+def git(cwd: str, *args: str) -> str:
+    return subprocess.run(["git", *args], cwd=cwd, check=True, stdout=subprocess.PIPE, text=True).stdout
+
+
+def make_repo(path: str, files: dict[str, str]) -> str:
+    os.makedirs(path, exist_ok=True)
+    git(path, "init", "-q")
+    commit_files(path, files)
+    return path
+
+
+def commit_files(path: str, files: dict[str, str]):
+    for rel_path, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(path, rel_path)) or path, exist_ok=True)
+        with open(os.path.join(path, rel_path), "w") as f:
+            f.write(content)
+    git(path, "add", "-A")
+    git(path, "commit", "-qm", "update")
+
+
+class Sysroot:
+    def __init__(self, root: Path, cache: build.BuildCache):
+        self.root = root
+        self.sdk = root / "sdk"
+        self.sdk.mkdir(parents=True)
+        self.cache = cache
+
+    def source(self, name: str, files: dict[str, str]) -> str:
+        return make_repo(str(self.root / "distribution-macOS" / name), files)
+
+    def build(self, packages: dict[str, SDKPackage], **kwargs):
+        build.build_packages(packages, str(self.root), str(self.sdk), self.cache, 1, **kwargs)
+
+    def header(self, name: str) -> Path:
+        return self.sdk / "usr" / "include" / name
+
+
+@pytest.fixture
+def make_sysroot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    def make(name: str = "root", max_size: int = 1 << 30) -> Sysroot:
+        return Sysroot(tmp_path / name, build.BuildCache(str(tmp_path / "cache"), max_size))
+
+    return make
+
+
+@pytest.fixture
+def sysroot(make_sysroot) -> Sysroot:
+    return make_sysroot()
+
+
+@pytest.fixture
+def header_package():
+    def make(files: list[str], name: str = "pkg", symlinks: Optional[list[Symlink]] = None, **kwargs) -> SDKPackage:
+        return SDKPackage(name=name, output_groups=[OutputGroup(sdk_dir="usr/include", files=files)], symlinks=symlinks, **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def build_args():
+    def make(**overrides) -> argparse.Namespace:
+        args = {
+            "jobs": 1,
+            "fetch_jobs": 1,
+            "only": [],
+            "worktree": "auto",
+            "materialize": "copy",
+            "keep_going": False,
+            "header_map": False,
+            "validate": False,
+            "prebuild_modules": False,
+            "clang": "clang",
+            "cmd_timeout": None,
+        }
+        return argparse.Namespace(**{**args, **overrides})
+
+    return make
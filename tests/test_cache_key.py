@@ -0,0 +1,24 @@
+import os
+
+import build
+from build import OutputGroup, SDKPackage, SDKTarget
+from conftest import commit_files, make_repo
+
+
+def test_cache_key_inputs(tmp_path, header_package):
+    repo = make_repo(str(tmp_path / "pkg"), {"a.h": "a\n"})
+    pkg = header_package(["a.h"], target_fields=["arch"])
+    key = build.package_cache_key(pkg, repo, {})
+    assert build.package_cache_key(pkg, repo, {}) == key
+
+    assert build.package_cache_key(pkg, repo, {}, SDKTarget(version="15.0")) == key
+    assert build.package_cache_key(pkg, repo, {}, SDKTarget(arch="x86_64")) != key
+    assert build.package_cache_key(pkg, repo, {"dep": "1"}) != build.package_cache_key(pkg, repo, {"dep": "2"})
+    other = SDKPackage(name="pkg", output_groups=[OutputGroup(sdk_dir="usr/include/sub", files=["a.h"])], target_fields=["arch"])
+    assert build.package_cache_key(other, repo, {}) != key
+
+    with open(os.path.join(repo, "a.h"), "w") as f:
+        f.write("dirty\n")
+    assert build.package_cache_key(pkg, repo, {}) == key
+    commit_files(repo, {"a.h": "dirty\n"})
+    assert build.package_cache_key(pkg, repo, {}) != key
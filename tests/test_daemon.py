@@ -0,0 +1,30 @@
+import os
+
+import build
+from conftest import commit_files, git
+
+
+def test_daemon_rebuilds_committed_changes_with_fresh_mtimes(sysroot, header_package, build_args, monkeypatch):
+    repo = sysroot.source("pkg", {"a.h": "v1\n"})
+    monkeypatch.setattr(build, "PACKAGES", {"pkg": header_package(["a.h"])})
+    monkeypatch.setattr(build, "finalize_sdk", lambda mirrors=None: None)
+    header = sysroot.root / f"oss-sdk{build.SDK_VERSION}" / "usr" / "include" / "a.h"
+
+    daemon = build.BuildDaemon(build_args(), [build.DEFAULT_TARGET], str(sysroot.root), sysroot.cache, None, str(sysroot.root / "sock"))
+    daemon.watch_sources()
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1000")
+    assert daemon.run_cycle(set(), False)["ok"]
+    assert header.read_text() == "v1\n" and os.stat(header).st_mtime == 1000
+
+    with open(os.path.join(repo, "a.h"), "w") as f:
+        f.write("uncommitted\n")
+    daemon.record_changes({os.path.join(repo, "a.h")})
+    assert not daemon.changed
+
+    commit_files(repo, {"a.h": "v2\n"})
+    git_dir = git(repo, "rev-parse", "--absolute-git-dir").strip()
+    daemon.record_changes({os.path.join(git_dir, "refs", "heads", "master"), os.path.join(git_dir, "refs", "heads", "main")})
+    assert daemon.changed and not daemon.forced
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "2000")
+    assert daemon.run_cycle(set(), False)["ok"]
+    assert header.read_text() == "v2\n" and os.stat(header).st_mtime == 2000
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import build
+from conftest import commit_files, git, make_repo
+
+
+def test_offline_submodule_update_from_local_mirror(tmp_path):
+    mirror_root = tmp_path / "mirrors"
+    url = "https://example.invalid/pkg.git"
+    sub = make_repo(str(tmp_path / "upstream"), {"pkg.h": "pkg\n"})
+    git(str(tmp_path), "clone", "-q", "--mirror", sub, str(mirror_root / "example.invalid" / "pkg.git"))
+
+    distribution = make_repo(str(tmp_path / "root" / "distribution-macOS"), {"README": "x\n"})
+    commit_files(distribution, {".gitmodules": f'[submodule "pkg"]\n\tpath = pkg\n\turl = {url}\n'})
+    commit = git(sub, "rev-parse", "HEAD").strip()
+    git(distribution, "update-index", "--add", "--cacheinfo", f"160000,{commit},pkg")
+    git(distribution, "commit", "-qm", "add pkg")
+
+    packages = {"pkg": build.SDKPackage(name="pkg", output_groups=[])}
+    mirrors = build.MirrorStore(str(mirror_root), offline=True)
+    build.fetch_sources(packages, str(tmp_path / "root"), 1, mirrors)
+    assert (tmp_path / "root" / "distribution-macOS" / "pkg" / "pkg.h").read_text() == "pkg\n"
+
+
+def test_offline_file_mirror(tmp_path):
+    mirrors = build.MirrorStore(str(tmp_path / "mirrors"), offline=True)
+    with pytest.raises(Exception, match="not mirrored"):
+        mirrors.refresh_file(build.TARGET_CONDITIONALS_URL)
+
+    source = tmp_path / "TargetConditionals.h"
+    source.write_text("#define TARGET_OS_MAC 1\n")
+    online = build.MirrorStore(str(tmp_path / "mirrors"), offline=False)
+    path = online.refresh_file(source.as_uri())
+    assert open(path).read() == "#define TARGET_OS_MAC 1\n"
+    assert build.MirrorStore(str(tmp_path / "mirrors"), offline=True).refresh_file(source.as_uri()) == path
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.startswith(".tmp-")]
@@ -0,0 +1,13 @@
+from build import Symlink
+
+
+def test_install_counts_symlinks_and_removals_separately(sysroot, header_package, capsys):
+    sysroot.source("pkg", {"a.h": "a\n", "b.h": "b\n"})
+    alias = [Symlink(dir="usr/include", link="alias.h", dest="a.h")]
+
+    sysroot.build({"pkg": header_package(["a.h", "b.h"], symlinks=alias)})
+    assert "pkg complete (3 of 3 sysroot entries updated)" in capsys.readouterr().out
+
+    sysroot.build({"pkg": header_package(["a.h"], symlinks=alias)})
+    assert "pkg complete (0 of 2 sysroot entries updated, 1 stale removed)" in capsys.readouterr().out
+    assert not sysroot.header("b.h").exists()
@@ -0,0 +1,32 @@
+import os
+
+import build
+
+
+def test_interrupted_install_removes_stale_files_on_resume(sysroot, header_package):
+    sysroot.source("pkg", {"a.h": "a\n", "b.h": "b\n", "c.h": "c\n"})
+    journal_path = str(sysroot.root / "install-journal.jsonl")
+
+    sysroot.build({"pkg": header_package(["a.h", "b.h"])})
+    build.InstallJournal(journal_path).begin("pkg", "interrupted", ["usr/include/a.h", "usr/include/c.h"])
+    sysroot.header("c.h").write_text("partial\n")
+
+    journal = build.InstallJournal(journal_path)
+    assert journal.installed["pkg"] == {
+        "key": None,
+        "files": ["usr/include/a.h", "usr/include/b.h", "usr/include/c.h"],
+    }
+    assert build.InstallJournal(journal_path).installed == journal.installed
+
+    sysroot.build({"pkg": header_package(["a.h"])})
+    assert sorted(os.listdir(sysroot.header(""))) == ["a.h"]
+    record = build.InstallJournal(journal_path).installed["pkg"]
+    assert record["key"] is not None and record["files"] == ["usr/include/a.h"]
+
+
+def test_interrupted_first_install_is_repeated(sysroot, header_package):
+    sysroot.source("pkg", {"a.h": "a\n"})
+    build.InstallJournal(str(sysroot.root / "install-journal.jsonl")).begin("pkg", "interrupted", ["usr/include/a.h"])
+
+    sysroot.build({"pkg": header_package(["a.h"])})
+    assert sysroot.header("a.h").read_text() == "a\n"
@@ -0,0 +1,21 @@
+import pytest
+
+
+def failing_pkg():
+    raise Exception("broken package")
+
+
+def test_keep_going_installs_packages_declared_after_a_failure(sysroot, header_package):
+    for name in ["broken", "dependent", "unrelated"]:
+        sysroot.source(name, {f"{name}.h": f"{name}\n"})
+    packages = {
+        "broken": header_package(["broken.h"], name="broken", build_func=failing_pkg),
+        "dependent": header_package(["dependent.h"], name="dependent", dependencies=["broken"]),
+        "unrelated": header_package(["unrelated.h"], name="unrelated"),
+    }
+
+    with pytest.raises(Exception, match="failed to build broken"):
+        sysroot.build(packages, keep_going=True)
+    assert sysroot.header("unrelated.h").read_text() == "unrelated\n"
+    assert not sysroot.header("broken.h").exists()
+    assert not sysroot.header("dependent.h").exists()
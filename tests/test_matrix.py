@@ -0,0 +1,45 @@
+import os
+
+import build
+from build import SDKTarget
+
+
+def gen_pkg():
+    os.makedirs("out", exist_ok=True)
+    with open("out/gen.h", "w") as f:
+        f.write(os.environ["GEN_VALUE"])
+
+
+def build_matrix(sysroot, packages, targets, rebuild=None) -> list[str]:
+    rebuilt_keys: set[str] = set()
+    results = []
+    for target in targets:
+        target_root = build.target_root(str(sysroot.root), target)
+        sdk = os.path.join(target_root, "sdk")
+        os.makedirs(sdk, exist_ok=True)
+        build.build_packages(
+            packages,
+            target_root,
+            sdk,
+            sysroot.cache,
+            1,
+            rebuild=rebuild,
+            source_root=str(sysroot.root),
+            target=target,
+            rebuilt_keys=rebuilt_keys,
+        )
+        with open(os.path.join(sdk, "usr", "include", "gen.h")) as f:
+            results.append(f.read())
+    return results
+
+
+def test_rebuild_reinstalls_shared_entry_in_every_target(sysroot, header_package, monkeypatch):
+    sysroot.source("gen", {"README": "gen\n"})
+    packages = {"gen": header_package(["out/gen.h"], name="gen", build_func=gen_pkg)}
+    targets = [build.DEFAULT_TARGET, SDKTarget(arch="x86_64")]
+
+    monkeypatch.setenv("GEN_VALUE", "v1")
+    assert build_matrix(sysroot, packages, targets) == ["v1", "v1"]
+    monkeypatch.setenv("GEN_VALUE", "v2")
+    assert build_matrix(sysroot, packages, targets) == ["v1", "v1"]
+    assert build_matrix(sysroot, packages, targets, rebuild={"gen"}) == ["v2", "v2"]
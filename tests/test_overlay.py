@@ -0,0 +1,81 @@
+import json
+import os
+import posixpath
+import struct
+from typing import Optional
+
+import build
+
+
+def overlay_paths(path: str) -> dict[str, str]:
+    def walk(node: dict, prefix: Optional[str]) -> dict[str, str]:
+        name = posixpath.join(prefix, node["name"]) if prefix is not None else ""
+        if node["type"] == "file":
+            return {name: node["external-contents"]}
+        return {k: v for child in node["contents"] for k, v in walk(child, name).items()}
+
+    with open(path) as f:
+        overlay = json.load(f)
+    return {k: v for root in overlay["roots"] for k, v in walk(root, None).items()}
+
+
+def test_overlay_entries_survive_eviction_by_other_build_roots(make_sysroot, header_package):
+    overlay_root = make_sysroot("overlay", max_size=1)
+    copy_root = make_sysroot("copy", max_size=1)
+    for root in [overlay_root, copy_root]:
+        root.source("pkg", {"a.h": f"{root.root.name}\n"})
+    packages = {"pkg": header_package(["a.h"])}
+
+    overlay_root.build(packages, materialize="overlay", header_map=True)
+    paths = list(overlay_paths(f"{overlay_root.sdk}-overlay.yaml").values())
+    assert paths
+
+    copy_root.build(packages)
+    assert all(os.path.exists(path) for path in paths)
+
+    os.unlink(f"{overlay_root.sdk}-overlay.yaml")
+    os.unlink(f"{overlay_root.sdk}.hmap")
+    copy_root.build(packages)
+    assert not any(os.path.exists(path) for path in paths)
+
+
+def read_header_map(path: str) -> dict[str, str]:
+    with open(path, "rb") as f:
+        data = f.read()
+    _, _, _, strings_offset, _, num_buckets, _ = struct.unpack_from("<4sHHIIII", data)
+
+    def string(offset: int) -> str:
+        start = strings_offset + offset
+        return data[start:data.index(b"\0", start)].decode()
+
+    mapping = {}
+    for i in range(num_buckets):
+        key, prefix, suffix = struct.unpack_from("<III", data, 24 + 12 * i)
+        if key:
+            mapping[string(key)] = string(prefix) + string(suffix)
+    return mapping
+
+
+def test_overlay_first_build_maps_finalized_headers(sysroot, header_package, build_args, tmp_path, monkeypatch):
+    sysroot.source("pkg", {"a.h": "a\n"})
+    sdk_lib = tmp_path / "MacOSX.sdk" / "usr" / "lib"
+    sdk_lib.mkdir(parents=True)
+    (sdk_lib / "libSystem.tbd").write_text("--- !tapi-tbd\n")
+    monkeypatch.setattr(build.SDKTarget, "sdk_path", property(lambda self: str(tmp_path / "MacOSX.sdk")))
+    mirror_file = tmp_path / "mirrors" / "files" / build.TARGET_CONDITIONALS_URL.split("://", 1)[1]
+    mirror_file.parent.mkdir(parents=True)
+    mirror_file.write_text("#define TARGET_OS_OSX 1\n")
+    mirrors = build.MirrorStore(str(tmp_path / "mirrors"), offline=True)
+
+    args = build_args(materialize="overlay", header_map=True)
+    packages = {"pkg": header_package(["a.h"])}
+    build.build_targets(args, packages, set(), [build.DEFAULT_TARGET], str(sysroot.root), sysroot.cache, {}, None, mirrors)
+
+    sdk = sysroot.root / f"oss-sdk{build.SDK_VERSION}"
+    overlay = overlay_paths(f"{sdk}-overlay.yaml")
+    assert open(overlay["usr/include/TargetConditionals.h"]).read() == "#define TARGET_OS_OSX 1\n"
+    assert open(overlay["usr/include/a.h"]).read() == "a\n"
+    assert "usr/lib/libSystem.tbd" in overlay
+    header_map = read_header_map(f"{sdk}.hmap")
+    assert open(header_map["TargetConditionals.h"]).read() == "#define TARGET_OS_OSX 1\n"
+    assert open(header_map["a.h"]).read() == "a\n"
@@ -0,0 +1,60 @@
+import os
+
+import build
+from conftest import git, make_repo
+
+
+def rewrite_in_place_pkg():
+    with open("a.h", "r+") as f:
+        f.write("BUILT")
+    os.makedirs("out", exist_ok=True)
+    with open("out/a.h", "w") as f:
+        f.write(open("a.h").read())
+
+
+def dirty_checkout(path: str) -> str:
+    repo = make_repo(path, {"a.h": "clean\n", "b.h": "b\n", "bin/tool": "#!/bin/sh\n"})
+    os.chmod(os.path.join(repo, "bin", "tool"), 0o755)
+    os.symlink("a.h", os.path.join(repo, "link.h"))
+    git(repo, "add", "-A")
+    git(repo, "commit", "-qm", "link")
+    with open(os.path.join(repo, "a.h"), "w") as f:
+        f.write("dirty\n")
+    os.unlink(os.path.join(repo, "b.h"))
+    os.unlink(os.path.join(repo, "link.h"))
+    with open(os.path.join(repo, "untracked.h"), "w") as f:
+        f.write("untracked\n")
+    return repo
+
+
+def test_worktree_matches_head(tmp_path):
+    repo = dirty_checkout(str(tmp_path / "repo"))
+    for mode in ["copy", "hardlink", "auto"]:
+        work = tmp_path / f"work-{mode}"
+        work.mkdir()
+        build.populate_worktree(repo, str(work), mode)
+        assert (work / "a.h").read_text() == "clean\n"
+        assert (work / "b.h").read_text() == "b\n"
+        assert os.readlink(work / "link.h") == "a.h"
+        assert os.access(work / "bin" / "tool", os.X_OK)
+        assert not (work / "untracked.h").exists()
+    assert open(os.path.join(repo, "a.h")).read() == "dirty\n"
+
+
+def test_dirty_checkout_does_not_reach_cache(sysroot, header_package):
+    repo = dirty_checkout(str(sysroot.root / "distribution-macOS" / "pkg"))
+    packages = {"pkg": header_package(["a.h"])}
+    sysroot.build(packages, rebuild={"pkg"})
+    assert sysroot.header("a.h").read_text() == "clean\n"
+
+    git(repo, "checkout", "--", ".")
+    key = build.package_cache_key(packages["pkg"], repo, {})
+    entry = sysroot.cache.lookup(key)
+    assert open(os.path.join(sysroot.cache.entry_path(key), "files", entry["files"][0])).read() == "clean\n"
+
+
+def test_hardlink_worktree_protects_sources_from_build_steps(sysroot, header_package):
+    repo = sysroot.source("pkg", {"a.h": "pristine\n"})
+    sysroot.build({"pkg": header_package(["out/a.h"], build_func=rewrite_in_place_pkg)}, worktree_mode="hardlink")
+    assert sysroot.header("a.h").read_text() == "BUILTine\n"
+    assert open(os.path.join(repo, "a.h")).read() == "pristine\n"